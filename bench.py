@@ -0,0 +1,331 @@
+# TE (Text Editor) - Performance benchmarks.
+# Created by alby13 - https://github.com/alby13/TE-Text-Editor
+#
+# Usage: python bench.py [benchmark ...] [--size-mb N]
+# With no names every benchmark runs. Results are printed as a small table.
+
+import argparse
+import curses
+import mmap
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+
+from pygments.lexers import get_lexer_by_name
+
+import te
+
+
+def _timed(func, repeat=3):
+    """Returns the best wall time of func() over repeat runs, and its last result."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _make_log_file(size_mb):
+    """Writes a temporary log-style file of roughly size_mb megabytes and returns its path."""
+    fd, path = tempfile.mkstemp(prefix="te_bench_", suffix=".log")
+    line = b"2026-10-17 12:00:00 INFO worker-7 processed request id=%08d in 12ms\n"
+    with os.fdopen(fd, "wb") as f:
+        written, i = 0, 0
+        target = size_mb * 1024 * 1024
+        while written < target:
+            chunk = b"".join(line % n for n in range(i, i + 10000))
+            f.write(chunk)
+            written += len(chunk)
+            i += 10000
+    return path
+
+
+def _report(name, rows):
+    print(f"\n{name}")
+    for label, seconds, size in rows:
+        rate = f"{size / seconds / 1e9:6.2f} GB/s" if size else ""
+        print(f"  {label:<44} {seconds * 1000:10.1f} ms  {rate}")
+
+
+def bench_line_index(args):
+    """Newline indexing throughput against the old read-and-splitlines open."""
+    path = _make_log_file(args.size_mb)
+    try:
+        size = os.path.getsize(path)
+
+        def old_open():
+            # What _load_file_content did before the piece table
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read().splitlines()
+
+        def current_open():
+            with open(path, "rb") as f:
+                data = f.read()
+            data.decode("utf-8")
+            return te.PieceTable(data)
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        rows = [
+            ("read + decode + splitlines (old open)", _timed(old_open)[0], size),
+            ("read + validate + PieceTable (current open)", _timed(current_open)[0], size),
+            ("build_line_index on bytes", _timed(lambda: te.build_line_index(data))[0], size),
+        ]
+        _report(f"line index ({args.size_mb} MiB)", rows)
+    finally:
+        os.remove(path)
+
+
+def _style_lookup_format(formatter, tokens):
+    """What CursesFormatter.format did before the attribute table."""
+    result = []
+    for ttype, value in tokens:
+        style_info = formatter.style.style_for_token(ttype)
+        style_key = (style_info['color'], style_info['bold'], style_info['italic'], style_info['underline'])
+        attr = 0
+        if style_key in formatter.color_map:
+            attr = curses.color_pair(formatter.color_map[style_key])
+            if style_info['bold']: attr |= curses.A_BOLD
+            if style_info['italic']: attr |= curses.A_ITALIC
+            if style_info['underline']: attr |= curses.A_UNDERLINE
+        result.append((value, attr))
+    return result
+
+
+def bench_format(args):
+    """Token to attribute lookup: style_for_token per token against the precomputed table."""
+    with open(te.__file__, "rb") as f:
+        buffer = te.PieceTable(f.read())
+    highlighter = te.SyntaxHighlighter(get_lexer_by_name("python"))
+    highlighter.update(buffer, 0, buffer.line_count() - 1)
+    lines = [highlighter.line_runs(buffer, y) for y in range(buffer.line_count())]
+    tokens = sum(len(runs) for runs in lines)
+    rows = []
+
+    def run(stdscr):
+        # color_pair() only works once curses is initialized
+        curses.start_color()
+        curses.use_default_colors()
+        formatter = te.CursesFormatter(style="default")
+        formatter.setup_colors()
+        rows.append(("style_for_token per token (old format)",
+                     _timed(lambda: [_style_lookup_format(formatter, runs) for runs in lines])[0], 0))
+        rows.append(("precomputed attribute table (format)",
+                     _timed(lambda: [formatter.format(runs, None) for runs in lines])[0], 0))
+
+    try:
+        curses.wrapper(run)
+    except curses.error:
+        print("\ntoken formatting: skipped, needs a terminal")
+        return
+    _report(f"token formatting ({len(lines)} lines, {tokens} tokens)", rows)
+    print(f"  speedup: {rows[0][1] / rows[1][1]:.1f}x")
+
+
+def _is_selected(editor, y, x):
+    """What is_selected did before selection spans."""
+    start_pos = min(editor.selection_start, editor.selection_end)
+    end_pos = max(editor.selection_start, editor.selection_end)
+    return start_pos <= (y, x) < end_pos
+
+
+def _per_char_draw(editor, screen_y, x_pos, width, tokens, line_idx):
+    """What draw_content did before run batching: one addstr per character."""
+    line_x_pos = editor.left_col
+    for text, attr in tokens:
+        if x_pos >= width - 1:
+            break
+        display_text = text[:width - x_pos - 1]
+        for char_index, char_to_draw in enumerate(display_text):
+            final_attr = attr
+            if _is_selected(editor, line_idx, line_x_pos + char_index):
+                final_attr |= curses.A_REVERSE
+            editor.stdscr.addstr(screen_y, x_pos + char_index, char_to_draw, final_attr)
+        x_pos += len(display_text)
+        line_x_pos += len(text)
+
+
+def bench_frame(args):
+    """Frame time of drawing a screen of highlighted text with a selection on it."""
+    rows = []
+    info = {}
+
+    def run(stdscr):
+        editor = te.TextEditor(stdscr)
+        editor.setup_colors()
+        editor._load_file_content(te.__file__)
+        height, width = stdscr.getmaxyx()
+        first, last = editor.top_line, editor.top_line + height - 5
+        buffer = editor.buffer
+        editor.highlighter.update(buffer, 0, last)
+        while editor.highlighter.job is not None:
+            time.sleep(0.01)
+            editor._poll_highlighter()
+        # Select the middle third of the screen
+        third = (last - first) // 3
+        editor.selection_start, editor.selection_end = (first + third, 4), (last - third, 8)
+        screen = []
+        for i, y in enumerate(range(first, last)):
+            runs = editor.highlighter.line_runs(buffer, y)
+            tokens = editor._format_line(y, runs, editor.left_col, editor.left_col + width + 100)
+            screen.append((i + 1, y, tokens))
+        info.update(size=f"{width}x{height}", lines=len(screen))
+
+        def per_char():
+            for screen_y, y, tokens in screen:
+                _per_char_draw(editor, screen_y, 0, width, tokens, y)
+
+        def batched():
+            for screen_y, y, tokens in screen:
+                editor._draw_tokens(screen_y, 0, width, tokens, editor.selection().spans(y))
+
+        def full_frame():
+            editor.damage.invalidate()
+            editor.draw_interface()
+            stdscr.refresh()
+
+        def unchanged_frame():
+            editor.draw_interface()
+            stdscr.refresh()
+
+        rows.append(("per-character addstr (old draw loop)", _timed(per_char, 10)[0], 0))
+        rows.append(("run-batched addstr (draw loop)", _timed(batched, 10)[0], 0))
+        rows.append(("full frame, every row repainted", _timed(full_frame, 10)[0], 0))
+        rows.append(("unchanged frame, no rows repainted", _timed(unchanged_frame, 10)[0], 0))
+
+    try:
+        curses.wrapper(run)
+    except curses.error:
+        print("\nframe drawing: skipped, needs a terminal")
+        return
+    _report(f"frame drawing ({info['size']} terminal, {info['lines']} lines)", rows)
+    print(f"  speedup: {rows[0][1] / rows[1][1]:.1f}x")
+
+
+class _ScriptedScreen:
+    """Wraps stdscr so getch() returns keys from a script, then -1."""
+
+    def __init__(self, stdscr, keys=()):
+        self._stdscr = stdscr
+        self.keys = deque(keys)
+
+    def getch(self):
+        return self.keys.popleft() if self.keys else -1
+
+    def __getattr__(self, name):
+        return getattr(self._stdscr, name)
+
+
+def bench_typing(args):
+    """Input throughput: a burst of typed keys handled one per frame against drained in one batch."""
+    text = "The quick brown fox jumps over the lazy dog, 0123456789.\n" * 200
+    keys = [ord(c) for c in text]
+    rows = []
+
+    def run(stdscr):
+        def one_per_frame():
+            # What the main loop did before draining: one key, then a frame
+            screen = _ScriptedScreen(stdscr, keys)
+            editor = te.TextEditor(screen)
+            editor.setup_colors()
+            while screen.keys:
+                editor.handle_key(screen.getch())
+                editor.draw_interface()
+                stdscr.refresh()
+
+        def drained():
+            screen = _ScriptedScreen(stdscr, keys)
+            editor = te.TextEditor(screen)
+            editor.setup_colors()
+            editor.handle_input()
+            editor.draw_interface()
+            stdscr.refresh()
+
+        rows.append(("one key per frame (old main loop)", _timed(one_per_frame, 1)[0], 0))
+        rows.append(("all waiting keys per frame (handle_input)", _timed(drained, 1)[0], 0))
+
+    try:
+        curses.wrapper(run)
+    except curses.error:
+        print("\ntyping: skipped, needs a terminal")
+        return
+    _report(f"typing ({len(keys)} keys)", rows)
+    for label, seconds, _ in rows:
+        print(f"  {label:<44} {len(keys) / seconds:10.0f} chars/s")
+
+
+def bench_save(args):
+    """Save time of a mapped file: every byte streamed against unchanged ranges copied."""
+    path = _make_log_file(args.size_mb)
+    out_path = path + ".saved"
+    rows = []
+    try:
+        size = os.path.getsize(path)
+
+        def edited(edit_size, edits=16):
+            # A mapped buffer, as _load_file_content opens large files
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                buffer = te.PieceTable(data, source_fd=os.dup(f.fileno()))
+            text = b"x" * (edit_size // edits)
+            for i in range(edits):
+                buffer.insert_bytes(size * i // edits, text)
+            return buffer
+
+        def timed_save(chunks, **kwargs):
+            # Best of three, each into a new file: replacing the last run's
+            # output would time freeing its blocks too. No fsync, which
+            # costs the same either way and depends on the disk.
+            best = None
+            for _ in range(3):
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+                start = time.perf_counter()
+                te.write_file_atomic(out_path, chunks(), sync=False, **kwargs)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+
+        buffer = edited(1024)
+        rows.append(("stream every byte, 1 KiB edited (iter_bytes)", timed_save(buffer.iter_bytes), size))
+        buffer.close()
+        for edit_size in (1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024):
+            buffer = edited(edit_size)
+            rows.append((f"copy unchanged ranges, {te.format_size(edit_size)} edited",
+                         timed_save(buffer.iter_ranges, source_fd=buffer.source_fd), size))
+            buffer.close()
+        _report(f"save ({args.size_mb} MiB mapped file)", rows)
+    finally:
+        os.remove(path)
+        if os.path.exists(out_path):
+            os.remove(out_path)
+
+
+BENCHMARKS = {
+    "line_index": bench_line_index,
+    "format": bench_format,
+    "frame": bench_frame,
+    "typing": bench_typing,
+    "save": bench_save,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TE performance benchmarks")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--size-mb", type=int, default=64, help="size of generated test files")
+    args = parser.parse_args()
+
+    for name in args.names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark: {name}")
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,19 +5,159 @@
 import curses
 import os
 import sys
-import copy
+import time
+import mmap
+import queue
+import heapq
+import random
+import select
+import signal
+import json
+import zlib
+import codecs
+import stat
+import struct
+import hashlib
+import marshal
+import tempfile
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from array import array
+from bisect import bisect_left, bisect_right
 import pyperclip
-from pygments import highlight, lex
+from pygments import highlight
+from pygments.lexer import RegexLexer, ExtendedRegexLexer
 from pygments.lexers import get_lexer_by_name, guess_lexer_for_filename
+from pygments.lexers.special import TextLexer
 from pygments.formatter import Formatter
-from pygments.token import Token
+from pygments.token import Token, Error, Whitespace
 from pygments.styles import get_all_styles, get_style_by_name
+import numpy
+
+# Files at least this large are memory-mapped and indexed in the background
+LAZY_LOAD_THRESHOLD = 64 * 1024 * 1024
+# Files at least this large are drawn as plain text, without syntax highlighting
+PLAIN_TEXT_THRESHOLD = 8 * 1024 * 1024
+# Bytes scanned by the background indexer per step
+INDEX_CHUNK_SIZE = 16 * 1024 * 1024
+# Byte range given to each worker process when indexing very large files
+PARALLEL_INDEX_CHUNK = 64 * 1024 * 1024
+PARALLEL_INDEX_WORKERS = os.cpu_count() or 1
+# Bytes handed to the vectorized newline search at a time
+INDEX_SCAN_BLOCK = 4 * 1024 * 1024
+# Lines decoded above and below the viewport on each redraw
+READ_AHEAD_LINES = 200
+# Decoded lines kept in the buffer's line cache before it is dropped
+LINE_CACHE_LIMIT = 4096
+# Undo history limits: RAM used before entries spill to disk, number of
+# steps kept, and how many recent steps stay uncompressed
+UNDO_MEMORY_BUDGET = 32 * 1024 * 1024
+UNDO_MAX_DEPTH = 10000
+UNDO_HOT_ENTRIES = 32
+# Rough per-entry and per-operation bookkeeping cost, in bytes
+UNDO_ENTRY_OVERHEAD = 100
+# Keep the undo history of saved files across sessions, in a hidden
+# .<name>.te-undo file next to each file. Set to False to never write them.
+PERSISTENT_UNDO = True
+# Persistent undo logs larger than this are rewritten without dead records
+UNDO_LOG_COMPACT_SIZE = 16 * 1024 * 1024
+# Saves are streamed to disk this many bytes at a time
+SAVE_CHUNK = 1024 * 1024
+# Flush saved files to disk before they replace the original. Slower, but a
+# crash or power loss right after a save cannot leave an empty file.
+SAVE_FSYNC = True
+# Unchanged pieces of a mapped file at least this long are copied from the
+# original file by the kernel on save instead of being written from memory
+SAVE_COPY_MIN = 64 * 1024
+# Lines of text given to Pygments when guessing a file's lexer
+LEXER_SAMPLE_LINES = 1000
+# Text read past the edited line when re-highlighting, in bytes. Pygments
+# rules may match across lines, so they are given this much to look at.
+HIGHLIGHT_WINDOW = 256 * 1024
+# Lines above an edit searched for Error tokens. A rule that failed there may
+# match once text below changes (e.g. an unterminated comment that gets
+# closed), so highlighting resumes from the earliest such line.
+HIGHLIGHT_BACKTRACK_LINES = 200
+# Formatted lines kept by the token cache
+TOKEN_CACHE_LINES = 4096
+# Lines the highlighting worker lexes before handing them to the main loop
+HIGHLIGHT_BATCH_LINES = 50
+# Seconds of lexing the main loop may do per frame before it hands off to the worker
+HIGHLIGHT_FRAME_BUDGET = 0.008
+# Text that is always left to the worker rather than lexed in the frame, in characters
+HIGHLIGHT_INLINE_TEXT = 32 * 1024
+# Long lines are formatted and drawn in chunks of about this many columns
+HIGHLIGHT_CHUNK = 4096
+# When highlighting has to resume this many lines above the screen, the
+# visible lines are lexed first from a guessed state while it catches up
+HIGHLIGHT_PREVIEW_GAP = 200
+# On Windows the main loop checks for background results this often, in seconds
+EVENT_POLL_INTERVAL = 0.05
+# Seconds a status bar message stays before it is cleared
+STATUS_MESSAGE_TIMEOUT = 10
+# Bracketed paste: the terminal wraps pasted text in these markers
+PASTE_START = b"\x1b[200~"
+PASTE_END = b"\x1b[201~"
+# Seconds a bracketed paste may stall before the text received so far is inserted
+PASTE_TIMEOUT = 1.0
+# Terminfo names of the special keys recognized in input that was read past a
+# paste's end marker, where curses no longer translates it (see EventLoop.get_key)
+KEY_CAPABILITIES = {
+    'kcuu1': curses.KEY_UP, 'kcud1': curses.KEY_DOWN, 'kcub1': curses.KEY_LEFT, 'kcuf1': curses.KEY_RIGHT,
+    'kLFT': curses.KEY_SLEFT, 'kRIT': curses.KEY_SRIGHT, 'kri': curses.KEY_SR, 'kind': curses.KEY_SF,
+    'kpp': curses.KEY_PPAGE, 'knp': curses.KEY_NPAGE, 'khome': curses.KEY_HOME, 'kend': curses.KEY_END,
+    'kich1': curses.KEY_IC, 'kdch1': curses.KEY_DC, 'kent': curses.KEY_ENTER,
+    **{f'kf{n}': curses.KEY_F0 + n for n in range(1, 13)},
+}
+# User key bindings, merged over DEFAULT_KEYMAP (see Keymap)
+KEYMAP_FILE = os.path.join(os.path.expanduser("~"), ".te_keymap.json")
+# Default key bindings: mode -> key name -> command name (TextEditor.COMMANDS)
+DEFAULT_KEYMAP = {
+    "editor": {
+        "^Z": "undo", "^Y": "redo", "^C": "copy", "^V": "paste", "^X": "cut",
+        # Selection keys (Shift + Arrows)
+        "KEY_SLEFT": "select_left", "KEY_SRIGHT": "select_right",
+        "KEY_SR": "select_up", "KEY_SF": "select_down",
+        # Standard cursor movement keys (these clear the selection)
+        "KEY_UP": "up", "KEY_DOWN": "down", "KEY_LEFT": "left", "KEY_RIGHT": "right",
+        "KEY_PPAGE": "page_up", "KEY_NPAGE": "page_down",
+        # Editing keys; 459 is the keypad Enter on Windows
+        "^J": "newline", "^M": "newline", "KEY_ENTER": "newline", "459": "newline",
+        "KEY_BACKSPACE": "backspace", "^?": "backspace", "^H": "backspace",
+        "KEY_DC": "delete", "^I": "tab",
+        # Function keys
+        "KEY_F1": "open", "KEY_F2": "save", "KEY_F3": "new", "KEY_F4": "theme",
+        "KEY_F5": "line_numbers", "KEY_F9": "toggle_menu",
+        "^[": "escape", "KEY_MOUSE": "mouse",
+    },
+    "menu": {
+        "KEY_LEFT": "menu_left", "KEY_RIGHT": "menu_right",
+        "KEY_UP": "menu_up", "KEY_DOWN": "menu_down", "^J": "menu_select",
+        "KEY_F9": "toggle_menu", "^[": "escape", "KEY_MOUSE": "menu_mouse",
+    },
+    "browser": {
+        "KEY_UP": "browser_up", "KEY_DOWN": "browser_down",
+        "KEY_BACKSPACE": "browser_parent", "^?": "browser_parent",
+        "^J": "browser_open", "KEY_ENTER": "browser_open",
+        "^[": "browser_cancel", "KEY_MOUSE": "browser_mouse",
+    },
+    "context_menu": {
+        "^[": "context_close", "KEY_MOUSE": "context_mouse",
+    },
+}
+
+# Guessed lexers by file extension (or by name, for files like Makefile)
+_LEXER_CACHE = {}
 
 # This custom formatter translates Pygments's style into curses color pairs.
 class CursesFormatter(Formatter):
     def __init__(self, **options):
         Formatter.__init__(self, **options)
         self.color_map = {}
+        self.attr_table = {}  # Token type -> final curses attribute
         self.next_color_pair = 1
         self.style = get_style_by_name(options.get('style', 'default'))
 
@@ -47,6 +187,10 @@ class CursesFormatter(Formatter):
                     # If we can't initialize more color pairs, stop trying
                     break
 
+        # Resolve every token type of the style to its attribute once, so
+        # format() is a single dict lookup per token
+        self.attr_table = {token: self._style_attr(token) for token, _ in self.style}
+
     def hex_to_curses_color(self, hex_color):
         # A simple mapping from hex to the 8 standard curses colors.
         # This is a simplification; a full 256-color implementation is more complex.
@@ -71,24 +215,1893 @@ class CursesFormatter(Formatter):
         if brightness > 192: return curses.COLOR_WHITE
         return -1 # Default
 
+    def _style_attr(self, ttype):
+        style_info = self.style.style_for_token(ttype)
+        style_key = (style_info['color'], style_info['bold'], style_info['italic'], style_info['underline'])
+
+        attr = 0  # Default attribute
+        if style_key in self.color_map:
+            pair_number = self.color_map[style_key]
+            attr = curses.color_pair(pair_number)
+            if style_info['bold']: attr |= curses.A_BOLD
+            if style_info['italic']: attr |= curses.A_ITALIC # Note: May not be supported in all terminals
+            if style_info['underline']: attr |= curses.A_UNDERLINE
+        return attr
+
+    def attr_for(self, ttype):
+        """Returns the attribute of a token type the table does not list yet.
+
+        Lexers may use subtypes the style does not define; like Pygments,
+        they inherit the attribute of their nearest known parent.
+        """
+        parent = ttype
+        while parent not in self.attr_table and parent.parent is not None:
+            parent = parent.parent
+        attr = self.attr_table[ttype] = self.attr_table.get(parent, 0)
+        return attr
+
     def format(self, tokensource, outfile):
         """Returns a list of (text, attribute) tuples"""
-        result = []
-        for ttype, value in tokensource:
-            style_info = self.style.style_for_token(ttype)
-            style_key = (style_info['color'], style_info['bold'], style_info['italic'], style_info['underline'])
-            
-            attr = 0  # Default attribute
-            if style_key in self.color_map:
-                pair_number = self.color_map[style_key]
-                attr = curses.color_pair(pair_number)
-                if style_info['bold']: attr |= curses.A_BOLD
-                if style_info['italic']: attr |= curses.A_ITALIC # Note: May not be supported in all terminals
-                if style_info['underline']: attr |= curses.A_UNDERLINE
-            
-            result.append((value, attr))
-        
-        return result
+        table = self.attr_table
+        return [(value, table[ttype] if ttype in table else self.attr_for(ttype)) for ttype, value in tokensource]
+
+_TokenType = type(Token)
+
+
+def _lex_lines(lexer, text, stack, pos=0):
+    """Lexes text[pos:] with a RegexLexer starting from a state stack, one line at a time.
+
+    Yields (runs, state) per line: the line's (ttype, value) runs and the
+    state stack at the start of the next line, or None when a token runs
+    across the line break so lexing cannot resume there. Text before pos
+    is only seen by lookbehinds, and keeps \\A from matching at pos. The
+    loop mirrors RegexLexer.get_tokens_unprocessed, which does not expose
+    its state.
+    """
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    size = len(text)
+    runs = []
+    finished = None  # A line that ended with the previous match
+    while pos < size:
+        before = tuple(statestack)
+        if finished is not None:
+            yield finished, before
+            finished = None
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is None:
+                    tokens = ()
+                elif type(action) is _TokenType:
+                    tokens = ((action, m.group()),)
+                else:
+                    tokens = [(ttype, value) for _, ttype, value in action(lexer, m)]
+                end = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    statetokens = tokendefs[statestack[-1]]
+                break
+        else:
+            if text[pos] == '\n':
+                # At EOL with no rule matching, RegexLexer resets to "root"
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                tokens = ((Whitespace, '\n'),)
+            else:
+                tokens = ((Error, text[pos]),)
+            end = pos + 1
+        # Split the match into lines
+        p = pos
+        for ttype, value in tokens:
+            if '\n' not in value:
+                if value:
+                    runs.append((ttype, value))
+                p += len(value)
+                continue
+            parts = value.split('\n')
+            for part in parts[:-1]:
+                if part:
+                    runs.append((ttype, part))
+                p += len(part) + 1
+                if p == end:
+                    if text.find('\n', pos, p - 1) >= 0 and not text[pos:p].isspace():
+                        # The match began on an earlier line and may have
+                        # been chosen by a lookahead into the next one
+                        yield runs, None
+                    else:
+                        finished = runs
+                else:
+                    # The next line starts inside this match. Resuming there
+                    # is only safe if the whole match is whitespace.
+                    yield runs, (before if text[pos:end].isspace() else None)
+                runs = []
+            if parts[-1]:
+                runs.append((ttype, parts[-1]))
+            p += len(parts[-1])
+        pos = end
+    if finished is not None:
+        yield finished, tuple(statestack)
+
+
+def _lex_lines_from(lexer, text, stack, y):
+    """Runs _lex_lines on text that starts at line y of the document."""
+    if y == 0:
+        return _lex_lines(lexer, text, stack)
+    # Lexing resumes after a line break, not at the start of the text
+    return _lex_lines(lexer, '\n' + text, stack, 1)
+
+
+def _lex_lines_plain(lexer, text):
+    """Fallback for lexers _lex_lines cannot resume: every line is lexed on its own."""
+    for line in text.split('\n')[:-1]:
+        runs = [(ttype, value.rstrip('\n')) for _, ttype, value in lexer.get_tokens_unprocessed(line + '\n')]
+        yield [run for run in runs if run[1]], ('root',)
+
+
+class _LongLineRuns(list):
+    """The runs of a line longer than HIGHLIGHT_CHUNK, split into chunks at
+    token boundaries so a frame only formats and draws the chunks it shows."""
+    __slots__ = ('chunk_columns', 'chunk_starts')
+
+    def __init__(self, runs):
+        super().__init__(runs)
+        self.chunk_columns = [0]  # First column of each chunk
+        self.chunk_starts = [0]  # Index of the first run of each chunk
+        col = 0
+        for i, (_, value) in enumerate(runs):
+            if col - self.chunk_columns[-1] >= HIGHLIGHT_CHUNK:
+                self.chunk_columns.append(col)
+                self.chunk_starts.append(i)
+            col += len(value)
+        self.chunk_starts.append(len(runs))
+
+    def chunk(self, i):
+        return self[self.chunk_starts[i]:self.chunk_starts[i + 1]]
+
+
+def _clip_runs(runs, start, end):
+    """Returns the part of a line's (text, attr) runs between two columns."""
+    clipped, x = [], 0
+    for text, attr in runs:
+        if x >= end:
+            break
+        if x + len(text) > start:
+            clipped.append((text[max(0, start - x):end - x], attr))
+        x += len(text)
+    return clipped
+
+
+# Incremental syntax highlighter. For every line it keeps the token runs and
+# the lexer state at the start of the line. An edit only forgets the lines it
+# touched; highlighting then resumes from the nearest line start with a known
+# state (or from a line above whose rules may now match differently: one with
+# Error tokens, or the one that entered the current state) and stops as soon
+# as the state at a line start is the same as before the edit, because the
+# old tokens from there on are still correct. A token spanning several lines
+# leaves the states inside it unknown, so an edit there lexes it again whole.
+#
+# With a HighlightWorker, update() lexes in the frame only while that fits in
+# HIGHLIGHT_FRAME_BUDGET; the rest runs as a job in the worker thread and
+# apply() commits the lines it sends back. Until then a line keeps its
+# previous tokens, or is drawn as plain text if it was edited. If the job
+# starts far above the screen, the visible lines are first lexed as a
+# preview from a guessed state.
+class SyntaxHighlighter:
+    def __init__(self, lexer, worker=None):
+        self.lexer = lexer
+        self.worker = worker
+        self.plain = isinstance(lexer, TextLexer)
+        self.resumable = isinstance(lexer, RegexLexer) and not isinstance(lexer, ExtendedRegexLexer)
+        self.runs = []  # Per line: [(ttype, value)], or None if it must be lexed again
+        self.states = [('root',)]  # Per line: state stack at its start, or None
+        self.valid = 0  # Lines before this one are highlighted correctly
+        # Lines redo_from..redo_until-1 must be lexed again even if they have runs
+        self.redo_from = self.redo_until = 0
+        self.last = 0  # Last line the renderer needs
+        self.job = None  # Job running in the worker
+        self.window = HIGHLIGHT_WINDOW
+        self.preview = {}  # Line -> runs lexed from a guessed state
+        self.preview_job = None
+
+    def close(self):
+        self._cancel()
+        self._cancel_preview()
+
+    def invalidate(self, y, removed, added):
+        """Called after an edit on line y that removed and added the given number of line breaks."""
+        # Anything the worker is lexing was read from the old text
+        self._cancel()
+        self._cancel_preview()
+        self.preview = {}
+        if y < self.redo_until:
+            self.redo_until = max(y, self.redo_until + added - removed)
+            if y < self.redo_from:
+                self.redo_from = max(y, self.redo_from + added - removed)
+        start, redo_until = self._context_start(y)
+        if start < redo_until:
+            # Lexed again, but they keep their tokens on screen meanwhile
+            if self.redo_until <= self.valid:
+                # The previous range has been lexed again already
+                self.redo_from, self.redo_until = start, redo_until
+            else:
+                self.redo_from = min(self.redo_from, start)
+                self.redo_until = max(self.redo_until, redo_until)
+        self.valid = min(self.valid, start)
+        if y >= len(self.runs):
+            return
+        if y + removed + 1 >= len(self.runs):
+            # The edit reaches past what was highlighted
+            del self.runs[y:]
+            del self.states[y + 1:]
+        else:
+            # The state at the start of line y is unchanged
+            self.runs[y:y + removed + 1] = [None] * (added + 1)
+            self.states[y + 1:y + removed + 1] = [None] * added
+
+    def _context_start(self, y):
+        """Returns the first line an edit on line y may change the tokens of,
+        and the line up to which lines must be lexed again even if their
+        state did not change.
+
+        A rule that failed to match on an earlier line, leaving Error
+        tokens, may match with the new text, so lexing resumes at the
+        earliest such line within HIGHLIGHT_BACKTRACK_LINES. Lines that
+        merely end in a non-root state are not all reopened: many lexers
+        (Rust, JavaScript) stay in one on nearly every line. Only the line
+        that entered the state line y starts in, or else the line above it,
+        is lexed again, because a rule that failed there (an unclosed
+        docstring, a Markdown heading before its underline) may now match.
+        """
+        for line in range(max(0, y - HIGHLIGHT_BACKTRACK_LINES), min(y, len(self.runs))):
+            runs = self.runs[line]
+            # Unmatched characters are always plain Error, and 'is' is much
+            # cheaper than a subtype test on every keystroke
+            if runs is not None and any(ttype is Error for ttype, _ in runs):
+                return line, y
+        line = min(y, len(self.states) - 1)
+        while self.states[line] is None:
+            line -= 1
+        state = self.states[line]
+        if len(state) > 1:
+            limit = max(1, line - HIGHLIGHT_BACKTRACK_LINES)
+            while line > limit and self.states[line - 1] == state:
+                line -= 1
+        if line == 0:
+            return y, y
+        return line - 1, line
+
+    def line_states(self, y):
+        """Returns the states at the start and end of line y, or None if either is unknown.
+
+        Together with the lexer and the line's text they determine its
+        tokens, which makes them a key for caching the formatted line.
+        """
+        if self.plain:
+            return ('root',), ('root',)
+        if y >= self.valid or self.states[y] is None or self.states[y + 1] is None:
+            return None
+        return self.states[y], self.states[y + 1]
+
+    def line_runs(self, buffer, y):
+        """Returns the (ttype, value) runs of line y, or the plain line if it has none yet."""
+        if not self.plain:
+            if y < len(self.runs) and self.runs[y] is not None:
+                # Lines past valid may still show the tokens from before an edit
+                return self.runs[y]
+            if y in self.preview:
+                return self.preview[y]
+        line = buffer.get_line(y)
+        return [(Token.Text, line)] if line else []
+
+    def update(self, buffer, first, last):
+        """Highlights the lines first..last, and so every line before them.
+
+        Without a worker this lexes right away. With one it lexes within
+        the frame's time budget and leaves the rest to a worker job.
+        """
+        if self.plain:
+            return
+        self.last = last = min(last, buffer.line_count() - 1)
+        deadline = time.perf_counter() + HIGHLIGHT_FRAME_BUDGET
+        while self.valid <= last:
+            y = self.valid
+            if y < len(self.runs) and self.runs[y] is not None and not self.redo_from <= y < self.redo_until:
+                # Unchanged since it was lexed from the same state
+                self.valid += 1
+                continue
+            if self.worker is None:
+                self._relex(buffer, last)
+                continue
+            if self.job is None and self._lex_inline(buffer, deadline):
+                continue
+            if self.job is None:
+                self._start_job(buffer)
+            if self.job.start < first - HIGHLIGHT_PREVIEW_GAP:
+                self._start_preview(buffer, first, last)
+            return
+
+    def _resume_line(self):
+        start = self.valid
+        while self.states[start] is None:
+            start -= 1
+        return start
+
+    def _window_end(self, buffer, start, window, last):
+        # Read a window of text, at least up to the last line that is needed
+        window_end = buffer.line_of(min(len(buffer), buffer.offset_of(start, 0) + window)) + 1
+        return min(buffer.line_count(), max(window_end, last + 1))
+
+    def _lines(self, buffer, start, window_end):
+        """Returns a generator of (runs, state) for lines start..window_end-1."""
+        text = buffer.read_lines(start, window_end) + '\n'
+        if self.resumable:
+            return _lex_lines_from(self.lexer, text, self.states[start], start)
+        return _lex_lines_plain(self.lexer, text)
+
+    def _relex(self, buffer, last):
+        start = self._resume_line()
+        window = HIGHLIGHT_WINDOW
+        while True:
+            window_end = self._window_end(buffer, start, window, last)
+            y = start
+            for runs, state in self._lines(buffer, start, window_end):
+                if self._commit(y, runs, state):
+                    return
+                y += 1
+            if window_end == buffer.line_count() or self._window_exhausted(start):
+                return
+            # A single token longer than the window
+            window *= 2
+
+    def _lex_inline(self, buffer, deadline):
+        """Lexes in the calling thread until the deadline. Returns False if the work should go to the worker."""
+        if time.perf_counter() >= deadline:
+            return False
+        start = self._resume_line()
+        count = buffer.line_count()
+        limit = buffer.offset_of(start, 0) + HIGHLIGHT_INLINE_TEXT
+        # Whole lines up to the limit; a longer line is left to the worker
+        window_end = count if limit >= len(buffer) else buffer.line_of(limit)
+        if window_end <= start:
+            return False
+        y = start
+        for runs, state in self._lines(buffer, start, window_end):
+            if self._commit(y, runs, state) or time.perf_counter() >= deadline:
+                return True
+            y += 1
+        return window_end == count or self._window_exhausted(start)
+
+    def _commit(self, y, runs, state):
+        """Stores the runs of line y and the state after it. Returns True when lexing can stop."""
+        if len(runs) > 1 and sum(len(value) for _, value in runs) > HIGHLIGHT_CHUNK:
+            runs = _LongLineRuns(runs)
+        if y >= len(self.runs):
+            self.runs.append(runs)
+            self.states.append(state)
+        else:
+            self.runs[y] = runs
+            if state is None or self.states[y + 1] != state:
+                self.states[y + 1] = state
+                # The next line was lexed from a different state, or starts
+                # inside a token that may have changed
+                if y + 1 < len(self.runs):
+                    self.runs[y + 1] = None
+        y += 1
+        self.valid = max(self.valid, y)
+        # Stop past the lines needed, or once back in step with the old highlighting
+        return state is not None and (y > self.last or (
+            not self.redo_from <= y < self.redo_until and y < len(self.runs) and self.runs[y] is not None))
+
+    def _window_exhausted(self, start):
+        """Handles lexing that reached the end of the window. Returns False if nothing usable was lexed."""
+        # The last line ended at the edge of the window rather than at a
+        # real line break, so go back to a line start with a known state
+        self.valid -= 1
+        while self.valid > start and self.states[self.valid] is None:
+            self.valid -= 1
+        if self.valid > start:
+            self.runs[self.valid] = None
+            return True
+        return False
+
+    # --- Background highlighting ---
+
+    def _start_job(self, buffer):
+        start = self._resume_line()
+        window_end = self._window_end(buffer, start, self.window, self.last)
+        self.job = _HighlightJob(self, buffer.version, start, window_end,
+                                 window_end == buffer.line_count(), self._lines(buffer, start, window_end))
+        self.worker.submit(self.job)
+
+    def _cancel(self):
+        if self.job:
+            self.job.cancelled = True
+            self.job = None
+
+    def _start_preview(self, buffer, first, last):
+        if self.preview_job or all(y in self.preview for y in (first, last)):
+            return
+        text = buffer.read_lines(first, last + 1) + '\n'
+        if len(text) > 2 * HIGHLIGHT_INLINE_TEXT:
+            return  # Long lines stay plain until the job reaches them
+        # The state at the top of the screen may be known from before an edit
+        state = self.states[first] if first < len(self.states) and self.states[first] else ('root',)
+        lines = _lex_lines_from(self.lexer, text, state, first) if self.resumable else _lex_lines_plain(self.lexer, text)
+        self.preview = {}
+        self.preview_job = _HighlightJob(self, buffer.version, first, last + 1, True, lines, preview=True)
+        self.worker.submit(self.preview_job)
+
+    def _cancel_preview(self):
+        if self.preview_job:
+            self.preview_job.cancelled = True
+            self.preview_job = None
+
+    def apply(self, buffer, job, lines):
+        """Commits lines lexed by the worker; lines is None once the job's window is done."""
+        if job is self.preview_job and job.version == buffer.version:
+            if lines is None:
+                self.preview_job = None
+            else:
+                for runs, _ in lines:
+                    self.preview[job.next_line] = runs
+                    job.next_line += 1
+            return
+        if job is not self.job:
+            return  # Cancelled
+        if job.version != buffer.version:
+            self._cancel()
+            return
+        if lines is None:
+            self.job = None
+            if job.failed:
+                # The lexer raised; show this file as plain text
+                self.plain = True
+            elif job.to_end or self._window_exhausted(job.start):
+                self.window = HIGHLIGHT_WINDOW
+            else:
+                # A single token longer than the window
+                self.window *= 2
+            return
+        for runs, state in lines:
+            if self._commit(job.next_line, runs, state):
+                self._cancel()
+                return
+            job.next_line += 1
+
+
+class _HighlightJob:
+    __slots__ = ('highlighter', 'version', 'start', 'next_line', 'window_end', 'to_end', 'lines',
+                 'preview', 'cancelled', 'failed')
+
+    def __init__(self, highlighter, version, start, window_end, to_end, lines, preview=False):
+        self.highlighter = highlighter
+        self.version = version  # Buffer version the text was read at
+        self.start = self.next_line = start
+        self.window_end = window_end
+        self.to_end = to_end  # The window reaches the end of the buffer
+        self.lines = lines
+        self.preview = preview  # Runs ahead of other jobs; its lines are only a preview
+        self.cancelled = False
+        self.failed = False
+
+
+# Queue for the results of a background thread. Posting a result also calls
+# wakeup, so the editor's main loop, which sleeps until there is something to
+# do, picks it up right away.
+class ResultQueue(queue.Queue):
+    def __init__(self, wakeup=None):
+        super().__init__()
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        if self.wakeup:
+            self.wakeup()
+
+
+# Lexes highlighting jobs off the main thread, so a slow lexer or a huge line
+# never delays keystrokes. Lines are posted to results in batches as
+# (job, lines), then (job, None) when the job's window is done; the editor
+# applies them from the main loop. Cancelled jobs are dropped between lines,
+# and preview jobs for the screen interrupt any other job.
+class HighlightWorker(threading.Thread):
+    def __init__(self, wakeup=None):
+        super().__init__(daemon=True)
+        self.results = ResultQueue(wakeup)
+        self._jobs = queue.Queue()
+        self._urgent = deque()
+
+    def submit(self, job):
+        if job.preview:
+            self._urgent.append(job)
+        self._jobs.put(job)
+
+    def run(self):
+        while True:
+            self._run(self._jobs.get())
+
+    def _run(self, job):
+        if job.cancelled or job.lines is None:
+            return  # Cancelled, or an urgent job that already ran
+        lines, job.lines = job.lines, None
+        batch = []
+        try:
+            for line in lines:
+                if job.cancelled:
+                    return
+                batch.append(line)
+                if len(batch) >= HIGHLIGHT_BATCH_LINES:
+                    self.results.put((job, batch))
+                    batch = []
+                while self._urgent and not job.preview:
+                    self._run(self._urgent.popleft())
+        except Exception:
+            # A lexer bug must not kill the worker
+            job.failed = True
+        if not job.cancelled:
+            if batch:
+                self.results.put((job, batch))
+            self.results.put((job, None))
+
+
+# Bounded LRU cache of formatted lines. It maps (lexer, theme, lexer states,
+# line text) to the line's (text, attr) runs, so redrawing a line that has
+# not changed needs no lexing or style lookups.
+class TokenCache:
+    def __init__(self, capacity=TOKEN_CACHE_LINES):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        runs = self.entries.get(key)
+        if runs is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return runs
+
+    def put(self, key, runs):
+        self.entries[key] = runs
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+# Damage tracking for the editor screen. It remembers a key for what was last
+# drawn on each row (its text, attributes and selection), so a frame only
+# repaints the rows whose key changed. Scrolls shift the rows that stay on
+# screen with scrl() instead of repainting them. Anything that draws outside
+# the editor's renderer (prompts, the file browser, a resize) must forget the
+# rows it touched, or invalidate() the whole screen.
+class ScreenDamage:
+    def __init__(self):
+        self.rows = {}
+        self.size = None
+        self.top_line = None
+        self.repainted = 0  # Rows drawn in the current frame
+
+    def invalidate(self):
+        self.rows.clear()
+        self.size = None
+        self.top_line = None
+
+    def forget(self, *rows):
+        for row in rows:
+            self.rows.pop(row, None)
+
+    def changed(self, row, key):
+        """Records key for row and returns True when the row must be redrawn."""
+        if row in self.rows and self.rows[row] == key:
+            return False
+        self.rows[row] = key
+        self.repainted += 1
+        return True
+
+    def scroll(self, stdscr, top_line, first, last):
+        """Scrolls rows first..last to follow top_line, keeping what is still visible."""
+        delta = 0 if self.top_line is None else top_line - self.top_line
+        self.top_line = top_line
+        if delta == 0:
+            return
+        if abs(delta) > last - first:
+            return  # Nothing stays on screen; the row keys no longer match anyway
+        height = stdscr.getmaxyx()[0]
+        try:
+            stdscr.setscrreg(first, last)
+            stdscr.scrollok(True)
+            stdscr.scroll(delta)
+        except curses.error:
+            self.invalidate()
+            return
+        finally:
+            stdscr.scrollok(False)
+            stdscr.setscrreg(0, height - 1)
+        moved = {}
+        for row in range(first, last + 1):
+            source = row + delta
+            if first <= source <= last and source in self.rows:
+                moved[row] = self.rows[source]
+        for row in range(first, last + 1):
+            self.rows.pop(row, None)
+        self.rows.update(moved)
+
+
+# The selected text as a list of ((y1, x1), (y2, x2)) ranges, sorted, merged
+# and each running from its start up to (not including) its end. The columns
+# selected on a line are worked out once per selection and shared by the
+# renderer and the copy and delete commands; a range that runs past the end
+# of a line selects the rest of it, newline included, as sys.maxsize.
+class Selection:
+    def __init__(self, ranges=()):
+        self.ranges = []
+        for start, end in sorted((min(r), max(r)) for r in ranges):
+            if start == end:
+                continue
+            if self.ranges and start <= self.ranges[-1][1]:
+                self.ranges[-1] = (self.ranges[-1][0], max(end, self.ranges[-1][1]))
+            else:
+                self.ranges.append((start, end))
+        self._starts = [start[0] for start, _ in self.ranges]
+        self._lines = {}
+
+    def __bool__(self):
+        return bool(self.ranges)
+
+    def spans(self, y):
+        """Returns the selected (start, end) column ranges of line y, in order."""
+        spans = self._lines.get(y)
+        if spans is None:
+            spans = []
+            for start, end in self.ranges[:bisect_right(self._starts, y)]:
+                if end[0] < y:
+                    continue
+                span = (start[1] if start[0] == y else 0, end[1] if end[0] == y else sys.maxsize)
+                if span[0] < span[1]:
+                    spans.append(span)
+            spans = self._lines[y] = tuple(spans)
+        return spans
+
+
+# Piece-table text buffer. The document is a sequence of pieces that point into
+# two byte buffers: the original file (never modified) and an append-only add
+# buffer. An edit only splits pieces, so its cost does not depend on the size
+# of the file or the length of the line being edited.
+#
+# The pieces are stored as a rope: a treap (randomized balanced binary tree)
+# whose nodes cache the byte length and newline count of their subtree, so
+# finding a line, inserting and splitting lines are all O(log n). Newline
+# offsets are kept in compact array('Q') tables rather than per-line objects,
+# which keeps memory close to the size of the file itself.
+#
+# The original buffer may be a read-only mmap of the file. In that case the
+# table starts with an empty newline index that LineIndexer fills in from a
+# background thread; until it is complete the buffer only exposes the lines
+# found so far and cannot be edited.
+class _PieceNode:
+    __slots__ = ('src', 'start', 'length', 'newlines', 'priority', 'left', 'right', 'size', 'lines')
+
+    def __init__(self, src, start, length, newlines):
+        self.src = src
+        self.start = start
+        self.length = length
+        self.newlines = newlines
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = length
+        self.lines = newlines
+
+    def update(self):
+        """Recomputes the cached subtree totals from the children."""
+        size, lines = self.length, self.newlines
+        if self.left:
+            size += self.left.size
+            lines += self.left.lines
+        if self.right:
+            size += self.right.size
+            lines += self.right.lines
+        self.size, self.lines = size, lines
+
+
+def _merge(a, b):
+    """Joins two treaps where every piece of a comes before every piece of b."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        a.update()
+        return a
+    b.left = _merge(a, b.left)
+    b.update()
+    return b
+
+
+class PieceTable:
+    def __init__(self, data=b'', encoding='utf-8', indexed=True, source_fd=None):
+        self.encoding = encoding
+        self._original = data
+        # An open descriptor of the file behind data, for copying it on save
+        self.source_fd = source_fd
+        self._added = bytearray()
+        # Sorted newline offsets for each source buffer
+        self._original_newlines = build_line_index(data) if indexed else array('Q')
+        self._added_newlines = array('Q')
+        # An unindexed buffer only knows the lines up to _scanned
+        self.complete = indexed
+        self._scanned = len(data) if indexed else 0
+        self._errors = self._error_handler()
+        self._root = None
+        if data:
+            self._root = _PieceNode(0, 0, len(data), len(self._original_newlines))
+        self._detect_newline()
+        self._line_cache = {}
+        # Bumped by every edit, so work based on an older text can be recognized
+        self.version = 0
+        # Called as listener(kind, offset, data) after every edit; kind is 'i' or 'd'
+        self.listener = None
+
+    def _error_handler(self):
+        # Lines are shown before an unindexed file has been validated, so
+        # decode them leniently; editing only starts once it is complete.
+        if not self.complete:
+            return 'replace'
+        return 'surrogateescape' if self.encoding == 'utf-8' else 'replace'
+
+    def _detect_newline(self):
+        """Keeps the file's line ending style for newly inserted lines."""
+        first_nl = self._original_newlines[0] if self._original_newlines else -1
+        self.newline = '\r\n' if first_nl > 0 and self._original[first_nl - 1:first_nl] == b'\r' else '\n'
+
+    @property
+    def lazy(self):
+        """True when the original text is a memory-mapped file."""
+        return isinstance(self._original, mmap.mmap)
+
+    def extend_index(self, offsets, scanned):
+        """Adds newline offsets found by the background indexer up to byte scanned."""
+        first_chunk = not self._original_newlines
+        self._original_newlines.extend(offsets)
+        self._scanned = scanned
+        if first_chunk and self._original_newlines:
+            self._detect_newline()
+        # Indexing happens before any edit, so the document is a single piece
+        if self._root is not None:
+            self._root.newlines = len(self._original_newlines)
+            self._root.update()
+        self._line_cache.clear()
+
+    def finish_index(self, encoding):
+        """Marks the index complete and settles the encoding found while scanning."""
+        self.encoding = encoding
+        self.complete = True
+        self._scanned = len(self._original)
+        self._errors = self._error_handler()
+        self._line_cache.clear()
+
+    def close(self):
+        """Releases the memory map behind a lazily loaded buffer."""
+        if self.lazy:
+            self._root = None
+            self._line_cache.clear()
+            try:
+                self._original.close()
+            except BufferError:
+                # The indexer still holds a view; the map is freed with it
+                pass
+        if self.source_fd is not None:
+            os.close(self.source_fd)
+            self.source_fd = None
+
+    def _source(self, src):
+        return (self._original, self._added)[src]
+
+    def _source_newlines(self, src):
+        return (self._original_newlines, self._added_newlines)[src]
+
+    def _count_newlines(self, src, start, length):
+        newlines = self._source_newlines(src)
+        return bisect_left(newlines, start + length) - bisect_left(newlines, start)
+
+    def _encode(self, text):
+        return text.encode(self.encoding, self._errors)
+
+    def _decode(self, raw):
+        return raw.decode(self.encoding, self._errors)
+
+    # --- Line index ---
+
+    def line_count(self):
+        return (self._root.lines if self._root else 0) + 1
+
+    def __len__(self):
+        """Total size of the document in bytes."""
+        return self._root.size if self._root else 0
+
+    def _newline_position(self, k):
+        """Returns the document offset of the k-th (0-based) newline."""
+        node, offset = self._root, 0
+        if node.src == 0 and node.start == 0 and node.left is None and node.right is None:
+            # Unedited file: the newline index answers directly
+            return self._original_newlines[k]
+        while node:
+            left_lines = node.left.lines if node.left else 0
+            if k < left_lines:
+                node = node.left
+                continue
+            k -= left_lines
+            offset += node.left.size if node.left else 0
+            if k < node.newlines:
+                newlines = self._source_newlines(node.src)
+                pos = newlines[bisect_left(newlines, node.start) + k]
+                return offset + pos - node.start
+            k -= node.newlines
+            offset += node.length
+            node = node.right
+        raise IndexError("newline index out of range")
+
+    def _line_bounds(self, y):
+        """Returns (start, end) document offsets of line y, excluding its newline."""
+        start = self._newline_position(y - 1) + 1 if y > 0 else 0
+        if y < self.line_count() - 1:
+            end = self._newline_position(y)
+        else:
+            end = len(self) if self.complete else self._scanned
+        return start, end
+
+    def _collect(self, node, base, start, end, parts):
+        """Appends the bytes of node's subtree that fall in [start, end) to parts."""
+        while node is not None and base < end and base + node.size > start:
+            self._collect(node.left, base, start, end, parts)
+            mid = base + (node.left.size if node.left else 0)
+            lo, hi = max(start, mid), min(end, mid + node.length)
+            if lo < hi:
+                parts.append(self._source(node.src)[node.start + lo - mid:node.start + hi - mid])
+            # Continue with the right subtree without recursing
+            base = mid + node.length
+            node = node.right
+
+    def _read(self, start, end):
+        """Returns the raw bytes of the document between two offsets."""
+        if start >= end:
+            return b''
+        parts = []
+        self._collect(self._root, 0, start, end, parts)
+        return b''.join(parts)
+
+    def get_line(self, y):
+        """Returns the text of line y without its line ending."""
+        line = self._line_cache.get(y)
+        if line is None:
+            start, end = self._line_bounds(y)
+            raw = self._read(start, end)
+            if raw.endswith(b'\r') and y < self.line_count() - 1:
+                raw = raw[:-1]
+            line = self._decode(raw)
+            if len(self._line_cache) >= LINE_CACHE_LIMIT:
+                self._line_cache.clear()
+            self._line_cache[y] = line
+        return line
+
+    def prefetch(self, first, last):
+        """Decodes lines first..last-1 into the line cache with a single read."""
+        first = max(0, first)
+        last = min(last, self.line_count())
+        if first >= last or all(y in self._line_cache for y in (first, last - 1)):
+            return
+        if len(self._line_cache) + (last - first) >= LINE_CACHE_LIMIT:
+            self._line_cache.clear()
+        start, _ = self._line_bounds(first)
+        _, end = self._line_bounds(last - 1)
+        raws = self._read(start, end).split(b'\n')
+        for y, raw in enumerate(raws, first):
+            if raw.endswith(b'\r') and y < self.line_count() - 1:
+                raw = raw[:-1]
+            self._line_cache[y] = self._decode(raw)
+
+    def line_length(self, y):
+        return len(self.get_line(y))
+
+    def iter_lines(self):
+        for y in range(self.line_count()):
+            yield self.get_line(y)
+
+    def offset_of(self, y, x):
+        """Converts a (line, column) position to a document byte offset.
+
+        Only the bytes up to column x are read and decoded, not the whole
+        line, so typing at the start of a huge line stays cheap.
+        """
+        start, end = self._line_bounds(y)
+        if x <= 0:
+            return start
+        # A character takes at most 4 bytes in UTF-8 and 1 in latin-1
+        stop = min(end, start + x * (4 if self.encoding == 'utf-8' else 1))
+        raw = self._read(start, stop)
+        if stop == end and raw.endswith(b'\r') and y < self.line_count() - 1:
+            raw = raw[:-1]
+        if self.encoding != 'utf-8' or raw[:x].isascii():
+            return start + min(x, len(raw))
+        return start + len(self._encode(self._decode(raw)[:x]))
+
+    def read_lines(self, first, last):
+        """Returns lines first..last-1 as one string joined with '\\n', using a single read."""
+        if first >= last:
+            return ""
+        start, _ = self._line_bounds(first)
+        _, end = self._line_bounds(last - 1)
+        raw = self._read(start, end)
+        if b'\r' in raw:
+            raw = raw.replace(b'\r\n', b'\n')
+        return self._decode(raw)
+
+    def line_of(self, offset):
+        """Returns the line that contains a document byte offset."""
+        node, base, y = self._root, 0, 0
+        while node:
+            left_size = node.left.size if node.left else 0
+            if offset < base + left_size:
+                node = node.left
+                continue
+            base += left_size
+            y += node.left.lines if node.left else 0
+            if offset < base + node.length:
+                y += self._count_newlines(node.src, node.start, offset - base)
+                break
+            base += node.length
+            y += node.newlines
+            node = node.right
+        return y
+
+    def position_of(self, offset):
+        """Converts a document byte offset to a (line, column) position."""
+        y = self.line_of(offset)
+        start, _ = self._line_bounds(y)
+        return y, len(self._decode(self._read(start, offset)))
+
+    def get_text(self, y1, x1, y2, x2):
+        """Returns the text between two positions, lines joined with '\\n'."""
+        if y1 == y2:
+            return self.get_line(y1)[x1:x2]
+        lines = [self.get_line(y1)[x1:]]
+        lines.extend(self.get_line(y) for y in range(y1 + 1, y2))
+        lines.append(self.get_line(y2)[:x2])
+        return "\n".join(lines)
+
+    def to_bytes(self):
+        return self._read(0, len(self))
+
+    def pieces(self):
+        """Yields (source, start, length) for every piece, in document order."""
+        stack, node = [], self._root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.src, node.start, node.length
+            node = node.right
+
+    def _piece_chunks(self, src, start, length, chunk_size):
+        source = self._source(src)
+        end = start + length
+        for pos in range(start, end, chunk_size):
+            yield source[pos:min(pos + chunk_size, end)]
+
+    def iter_bytes(self, chunk_size=SAVE_CHUNK):
+        """Yields the raw bytes of the document in order, at most chunk_size at a time."""
+        for piece in self.pieces():
+            yield from self._piece_chunks(*piece, chunk_size)
+
+    def iter_ranges(self, chunk_size=SAVE_CHUNK, min_copy=SAVE_COPY_MIN):
+        """Like iter_bytes, but yields (offset, length) for long unchanged pieces.
+
+        Those ranges of the original file can be copied from source_fd
+        without reading them, so saving a few edits to a huge file only
+        writes the edits. Without a source_fd this is iter_bytes.
+        """
+        if self.source_fd is None:
+            yield from self.iter_bytes(chunk_size)
+            return
+        for src, start, length in self.pieces():
+            if src == 0 and length >= min_copy:
+                yield start, length
+            else:
+                yield from self._piece_chunks(src, start, length, chunk_size)
+
+    # --- Editing ---
+
+    def _split(self, node, offset):
+        """Splits a treap into the first offset bytes and the rest, cutting a piece if needed."""
+        if node is None:
+            return None, None
+        left_size = node.left.size if node.left else 0
+        if offset <= left_size:
+            left, node.left = self._split(node.left, offset)
+            node.update()
+            return left, node
+        if offset >= left_size + node.length:
+            node.right, right = self._split(node.right, offset - left_size - node.length)
+            node.update()
+            return node, right
+        # The cut falls inside this node's piece
+        cut = offset - left_size
+        tail_start, tail_length = node.start + cut, node.length - cut
+        tail = _PieceNode(node.src, tail_start, tail_length,
+                          self._count_newlines(node.src, tail_start, tail_length))
+        node.length = cut
+        node.newlines = self._count_newlines(node.src, node.start, cut)
+        right, node.right = _merge(tail, node.right), None
+        node.update()
+        return node, right
+
+    def _last_piece_path(self, node):
+        """Returns the path from node down to the last piece of its subtree."""
+        path = []
+        while node is not None:
+            path.append(node)
+            node = node.right
+        return path
+
+    def _forget_lines(self, y, removed, added):
+        """Updates the line cache for an edit on line y that removed and added line breaks.
+
+        Only the edited lines are dropped; the lines after them keep their
+        text under their new numbers.
+        """
+        cache = self._line_cache
+        if removed == added:
+            for line in range(y, y + removed + 1):
+                cache.pop(line, None)
+        else:
+            shift = added - removed
+            self._line_cache = {line if line < y else line + shift: text
+                                for line, text in cache.items() if not y <= line <= y + removed}
+
+    def insert_bytes(self, offset, data):
+        """Inserts raw bytes at a document offset."""
+        if not data:
+            return
+        add_start = len(self._added)
+        self._added += data
+        pos = data.find(b'\n')
+        while pos != -1:
+            self._added_newlines.append(add_start + pos)
+            pos = data.find(b'\n', pos + 1)
+        nl_count = self._count_newlines(1, add_start, len(data))
+        self._forget_lines(self.line_of(offset), 0, nl_count)
+
+        left, right = self._split(self._root, offset)
+        # Typing appends to the add buffer right after the previous insert,
+        # so the previous piece can simply grow instead of adding a new one.
+        path = self._last_piece_path(left)
+        if path and path[-1].src == 1 and path[-1].start + path[-1].length == add_start:
+            path[-1].length += len(data)
+            path[-1].newlines += nl_count
+            for node in reversed(path):
+                node.update()
+        else:
+            left = _merge(left, _PieceNode(1, add_start, len(data), nl_count))
+        self._root = _merge(left, right)
+        self.version += 1
+        if self.listener:
+            self.listener('i', offset, bytes(data))
+
+    def delete_bytes(self, offset, length):
+        """Deletes a byte range and returns the removed bytes."""
+        end = min(offset + length, len(self))
+        if offset >= end:
+            return b''
+        removed = self._read(offset, end)
+        first = self.line_of(offset)
+        self._forget_lines(first, self.line_of(end) - first, 0)
+        left, rest = self._split(self._root, offset)
+        _, right = self._split(rest, end - offset)
+        self._root = _merge(left, right)
+        self.version += 1
+        if self.listener:
+            self.listener('d', offset, removed)
+        return removed
+
+    def insert(self, y, x, text):
+        """Inserts text at (y, x) and returns the position just after it."""
+        self.insert_bytes(self.offset_of(y, x), self._encode(text.replace('\n', self.newline)))
+        lines = text.split('\n')
+        if len(lines) == 1:
+            return y, x + len(text)
+        return y + len(lines) - 1, len(lines[-1])
+
+    def delete(self, y1, x1, y2, x2):
+        """Deletes the text between two positions and returns it."""
+        start = self.offset_of(y1, x1)
+        end = self.offset_of(y2, x2)
+        removed = self.delete_bytes(start, end - start)
+        return self._decode(removed).replace('\r\n', '\n')
+
+
+def content_fingerprint(data):
+    """Hex digest identifying a file's content; keys the persistent undo log."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_identity(path):
+    """Fingerprint of a file by its size, modification time and inode.
+
+    Stands in for content_fingerprint when a save copied most of the file
+    without reading it; like make or git's index, it trusts the file not to
+    change without its modification time changing.
+    """
+    st = os.stat(path)
+    return f"stat:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+
+
+def format_size(size):
+    """Formats a byte count for the status bar, e.g. '1.5 MB'."""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    """Appends length bytes at offset of src_fd to dst_fd, inside the kernel where possible."""
+    end = offset + length
+    copies = []
+    if hasattr(os, 'copy_file_range'):
+        copies.append(lambda pos: os.copy_file_range(src_fd, dst_fd, end - pos, pos))
+    if hasattr(os, 'sendfile'):
+        copies.append(lambda pos: os.sendfile(dst_fd, src_fd, pos, end - pos))
+    for copy in copies:
+        try:
+            while offset < end:
+                copied = copy(offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            # Not supported for these files (e.g. across filesystems); the
+            # next way carries on from where this one stopped
+            continue
+        if offset == end:
+            return
+    while offset < end:
+        data = os.pread(src_fd, min(SAVE_CHUNK, end - offset), offset)
+        if not data:
+            raise OSError("the original file was truncated while saving")
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        offset += len(data)
+
+
+def _write_chunks(f, chunks, source_fd):
+    """Writes chunks to the open file f. Returns the content hasher, or None if ranges were copied."""
+    hasher = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        if isinstance(chunk, tuple):
+            f.flush()
+            _copy_range(source_fd, f.fileno(), *chunk)
+            # Let the writer pick up the position the copy left
+            f.seek(0, os.SEEK_END)
+            hasher = None
+            continue
+        f.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+    return hasher
+
+
+def save_in_place(path):
+    """True when path has to be overwritten rather than replaced on save.
+
+    Replacing a file with other hard links would split it from them, and
+    a directory we may not write to has no room for the temporary file.
+    """
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return st.st_nlink > 1 or not os.access(os.path.dirname(path), os.W_OK | os.X_OK)
+
+
+def _same_file(fd, st):
+    if fd is None or st is None:
+        return False
+    source = os.fstat(fd)
+    return (source.st_dev, source.st_ino) == (st.st_dev, st.st_ino)
+
+
+def _write_in_place(path, chunks, sync, source_fd):
+    """Overwrites path with the chunks. Not crash safe, but keeps its inode."""
+    with open(path, 'wb', buffering=SAVE_CHUNK) as f:
+        hasher = _write_chunks(f, chunks, source_fd)
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+    return hasher.hexdigest() if hasher is not None else file_identity(path)
+
+
+def write_file_atomic(path, chunks, sync=SAVE_FSYNC, source_fd=None):
+    """Writes the byte chunks to path without ever leaving it half written.
+
+    The chunks are streamed to a temporary file in the same directory,
+    which then replaces path with os.replace, so a crash leaves either the
+    old file or the new one. The file keeps its permissions, owner and
+    group (as far as we may set them), and a symlink keeps pointing at it.
+    Returns the content fingerprint, hashed as the chunks are written.
+
+    A chunk can also be an (offset, length) range of source_fd, as yielded
+    by PieceTable.iter_ranges, which is copied without being read. The
+    content is then not hashed and the result is file_identity(path).
+
+    When the file has other hard links, or no temporary file can be made
+    next to it, it is overwritten in place like before. The chunks must
+    then not be read from the file itself.
+    """
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    temp_path = None
+    if st is None or st.st_nlink == 1:
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".te-save", dir=directory)
+        except PermissionError:
+            if st is None:
+                raise
+    if temp_path is None:
+        if _same_file(source_fd, st):
+            raise OSError(f"cannot overwrite {name} in place while reading from it")
+        return _write_in_place(path, chunks, sync, source_fd)
+    try:
+        with os.fdopen(fd, 'wb', buffering=SAVE_CHUNK) as f:
+            if st is not None:
+                mode = stat.S_IMODE(st.st_mode)
+                if hasattr(os, 'chown'):
+                    # Only root may give a file away; a group we belong to is
+                    # still worth keeping
+                    try:
+                        os.chown(temp_path, st.st_uid, st.st_gid)
+                    except OSError:
+                        try:
+                            os.chown(temp_path, -1, st.st_gid)
+                        except OSError:
+                            pass
+            else:
+                # A new file gets the usual permissions rather than mkstemp's 0600
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(temp_path, mode)
+            hasher = _write_chunks(f, chunks, source_fd)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    if sync and os.name != 'nt':
+        # Make the rename itself durable
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+    return hasher.hexdigest() if hasher is not None else file_identity(path)
+
+
+def build_line_index(data, start=0, end=None):
+    """Returns an array('Q') with the offset of every b'\\n' in data[start:end].
+
+    data can be bytes, bytearray or an mmap. The range is compared with
+    NumPy in INDEX_SCAN_BLOCK slices, so no Python object is created per
+    line.
+    """
+    if end is None:
+        end = len(data)
+    offsets = array('Q')
+    for pos in range(start, end, INDEX_SCAN_BLOCK):
+        stop = min(pos + INDEX_SCAN_BLOCK, end)
+        block = numpy.frombuffer(data, dtype=numpy.uint8, count=stop - pos, offset=pos)
+        hits = numpy.flatnonzero(block == 10).astype(numpy.uint64)
+        hits += pos
+        offsets.frombytes(hits.tobytes())
+    return offsets
+
+
+def _utf8_boundary(data, pos):
+    """Moves pos forward past UTF-8 continuation bytes so a range never starts mid-character."""
+    limit = min(pos + 3, len(data))
+    while pos < limit and 0x80 <= data[pos] <= 0xBF:
+        pos += 1
+    return pos
+
+
+def _is_valid_utf8(data, start, end):
+    """Checks data[start:end] as UTF-8, with both ends moved to character boundaries."""
+    start, end = _utf8_boundary(data, start), _utf8_boundary(data, end)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for pos in range(start, end, INDEX_SCAN_BLOCK):
+            decoder.decode(data[pos:min(pos + INDEX_SCAN_BLOCK, end)])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _index_file_range(path, start, end):
+    """Process pool worker: indexes and validates one byte range of a file.
+
+    Returns the newline offsets as raw array('Q') bytes (cheap to pickle)
+    and whether the range is valid UTF-8.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offsets = build_line_index(data, start, end)
+        valid = _is_valid_utf8(data, start, end)
+    return offsets.tobytes(), valid
+
+
+class LineIndexer(threading.Thread):
+    """Scans a memory-mapped file for newlines and validates it as UTF-8.
+
+    Large files are split into PARALLEL_INDEX_CHUNK byte ranges that a
+    process pool indexes in parallel; smaller ones (or single-core machines)
+    are scanned by this thread. Either way results are posted to a queue in
+    file order as ('lines', offsets, scanned) for every chunk and
+    ('done', encoding, fingerprint) at the end; the editor applies them to
+    the buffer from the main loop so the buffer is only touched by one
+    thread. The content fingerprint is hashed chunk by chunk in file order.
+    """
+
+    def __init__(self, data, path=None, wakeup=None):
+        super().__init__(daemon=True)
+        self.data = data
+        self.path = path
+        self.results = ResultQueue(wakeup)
+        self.stop_event = threading.Event()
+        self.encoding = 'utf-8'
+        self.hasher = hashlib.blake2b(digest_size=16)
+        # End of the last chunk posted to results
+        self.scanned = 0
+
+    def run(self):
+        try:
+            pos = 0
+            if self.path and PARALLEL_INDEX_WORKERS > 1 and len(self.data) > PARALLEL_INDEX_CHUNK:
+                try:
+                    pos = self._run_parallel()
+                except Exception:
+                    # The pool could not be used here; scan the rest in this thread
+                    pos = self.scanned
+            if pos is not None and self._run_serial(pos):
+                self.results.put(('done', self.encoding, self.hasher.hexdigest()))
+        except (ValueError, BufferError):
+            # The map was closed because another file was opened
+            return
+
+    def _chunk_done(self, start, end, offsets, valid):
+        if not valid:
+            # Same fallback as a normal open: treat it as latin-1
+            self.encoding = 'latin-1'
+        # hashlib releases the GIL on large inputs, so this runs alongside the UI
+        self.hasher.update(memoryview(self.data)[start:end])
+        self.results.put(('lines', offsets, end))
+        self.scanned = end
+
+    def _run_serial(self, pos):
+        """Scans from pos to the end in this thread. Returns False if stopped."""
+        size = len(self.data)
+        while pos < size:
+            if self.stop_event.is_set():
+                return False
+            end = min(pos + INDEX_CHUNK_SIZE, size)
+            offsets = build_line_index(self.data, pos, end)
+            valid = self.encoding != 'utf-8' or _is_valid_utf8(self.data, pos, end)
+            self._chunk_done(pos, end, offsets, valid)
+            pos = end
+        return True
+
+    def _run_parallel(self):
+        """Indexes the file with a process pool.
+
+        Returns the offset reached (the end of the file, or the first chunk
+        that failed so the serial scan can take over), or None if stopped.
+        """
+        size = len(self.data)
+        ranges = [(pos, min(pos + PARALLEL_INDEX_CHUNK, size)) for pos in range(0, size, PARALLEL_INDEX_CHUNK)]
+        # Spawned workers are safe to start from a thread on every platform
+        pool = ProcessPoolExecutor(max_workers=PARALLEL_INDEX_WORKERS,
+                                   mp_context=multiprocessing.get_context('spawn'))
+        futures = []
+        try:
+            futures = [pool.submit(_index_file_range, self.path, start, end) for start, end in ranges]
+            for (start, end), future in zip(ranges, futures):
+                while True:
+                    if self.stop_event.is_set():
+                        return None
+                    try:
+                        raw, valid = future.result(timeout=0.1)
+                        break
+                    except FutureTimeout:
+                        continue
+                    except Exception:
+                        return start
+                offsets = array('Q')
+                offsets.frombytes(raw)
+                self._chunk_done(start, end, offsets, valid)
+            return size
+        finally:
+            # shutdown(cancel_futures=True) needs Python 3.9
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+# The undo log is an append-only file next to the document. It starts with
+# MAGIC and holds records of a one-byte kind, a length and a payload:
+#   b'E'  one undo entry, zlib-compressed JSON of its operations
+#   b'C'  a checkpoint written on save: the path, a fingerprint of the saved
+#         content and the undo stack as [record offset, cursor y, cursor x]
+# Every checkpoint is followed by a trailer holding its offset, so opening a
+# file reads only the end of the log; entries are read when they are undone.
+class PersistentUndoLog:
+    MAGIC = b"TEUNDO1\n"
+    TRAILER_MAGIC = b"TEUNDOC\n"
+    _RECORD = struct.Struct('<cI')
+    _TRAILER = struct.Struct('<Q8s')
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        directory, name = os.path.split(self.path)
+        self.log_path = os.path.join(directory, f".{name}.te-undo")
+        self._map = None
+        self._valid = False  # The log on disk belongs to this document
+        self._compacted_size = 0
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
+
+    def _remap(self):
+        self.close()
+        with open(self.log_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_record(self, offset):
+        if self._map is None or offset + self._RECORD.size > len(self._map):
+            self._remap()
+        kind, length = self._RECORD.unpack_from(self._map, offset)
+        start = offset + self._RECORD.size
+        if start + length > len(self._map):
+            self._remap()
+        return kind, self._map[start:start + length]
+
+    def load(self, fingerprint):
+        """Returns the saved undo stack as [offset, y, x] items, or [] if the log does not match fingerprint."""
+        try:
+            if os.path.getsize(self.log_path) < len(self.MAGIC) + self._TRAILER.size:
+                return []
+            self._remap()
+            if self._map[:len(self.MAGIC)] != self.MAGIC:
+                return []
+            offset, magic = self._TRAILER.unpack_from(self._map, len(self._map) - self._TRAILER.size)
+            if magic != self.TRAILER_MAGIC:
+                return []
+            kind, payload = self._read_record(offset)
+            checkpoint = json.loads(payload)
+            identity = file_identity(self.path)
+        except (OSError, ValueError, struct.error):
+            # No log yet, or one we cannot read: the next save starts over
+            return []
+        # Saves that copied the file without reading it record its identity
+        if kind != b'C' or checkpoint.get('path') != self.path or checkpoint.get('hash') not in (fingerprint, identity):
+            return []
+        try:
+            # Logs written by older versions were readable by everyone
+            os.chmod(self.log_path, 0o600)
+        except OSError:
+            pass
+        self._valid = True
+        self._compacted_size = len(self._map)
+        return checkpoint['stack']
+
+    def read_entry(self, offset):
+        """Returns the operations stored in the entry record at offset."""
+        kind, payload = self._read_record(offset)
+        return [(op_kind, op_offset, data.encode('latin-1'))
+                for op_kind, op_offset, data in json.loads(zlib.decompress(payload))]
+
+    @staticmethod
+    def _create(path):
+        """Opens path for writing, truncated and readable only by its owner.
+
+        The log keeps deleted text, so it must not get a wider mode from the
+        umask or from an older file at the same path.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o600)
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, 0o600)
+        return os.fdopen(fd, 'wb')
+
+    def _append(self, records):
+        """Writes (kind, payload) records at the end of the log and returns their offsets."""
+        if not self._valid:
+            # Anything already there belongs to another version of the file
+            self.close()
+            with self._create(self.log_path) as f:
+                f.write(self.MAGIC)
+            self._valid = True
+            self._compacted_size = len(self.MAGIC)
+        offsets = []
+        with open(self.log_path, 'ab') as f:
+            pos = f.seek(0, os.SEEK_END)
+            for kind, payload in records:
+                offsets.append(pos)
+                f.write(self._RECORD.pack(kind, len(payload)))
+                f.write(payload)
+                pos += self._RECORD.size + len(payload)
+        return offsets
+
+    def append_entries(self, entries_ops):
+        """Stores the operations of several entries. Returns the record offsets."""
+        records = []
+        for ops in entries_ops:
+            # latin-1 maps every byte to one code point, so any data survives JSON
+            data = json.dumps([(kind, offset, data.decode('latin-1')) for kind, offset, data in ops])
+            records.append((b'E', zlib.compress(data.encode('ascii'), 1)))
+        return self._append(records)
+
+    def remove(self):
+        """Deletes the log file; the next write starts a new one."""
+        self.close()
+        self._valid = False
+        try:
+            os.remove(self.log_path)
+        except FileNotFoundError:
+            pass
+
+    def checkpoint(self, stack, fingerprint):
+        """Records the undo stack that belongs to the content with this fingerprint."""
+        payload = json.dumps({'path': self.path, 'hash': fingerprint, 'stack': stack}).encode('utf-8')
+        offset, = self._append([(b'C', payload)])
+        with open(self.log_path, 'ab') as f:
+            f.write(self._TRAILER.pack(offset, self.TRAILER_MAGIC))
+
+    def needs_compaction(self):
+        size = os.path.getsize(self.log_path)
+        return size > UNDO_LOG_COMPACT_SIZE and size > 2 * self._compacted_size
+
+    def compact(self, offsets):
+        """Rewrites the log with only the entry records at offsets. Returns their new offsets."""
+        temp_path = self.log_path + ".tmp"
+        new_offsets = []
+        self._remap()
+        with self._create(temp_path) as f:
+            f.write(self.MAGIC)
+            for offset in offsets:
+                kind, length = self._RECORD.unpack_from(self._map, offset)
+                new_offsets.append(f.tell())
+                f.write(self._map[offset:offset + self._RECORD.size + length])
+        self.close()
+        os.replace(temp_path, self.log_path)
+        self._compacted_size = os.path.getsize(self.log_path)
+        return new_offsets
+
+
+class _UndoEntry:
+    """One undo step. Its operations are held in one of four forms:
+    ops (a list, ready to replay), packed (zlib-compressed), spill (an
+    (offset, length) of packed bytes in the journal's temporary file) or
+    disk (the offset of its record in the persistent undo log)."""
+    __slots__ = ('ops', 'cursor', 'packed', 'spill', 'disk')
+
+    def __init__(self, cursor):
+        self.ops = []
+        self.cursor = cursor
+        self.packed = None
+        self.spill = None
+        self.disk = None
+
+    def memory(self):
+        """Approximate bytes of RAM held by this entry."""
+        if self.ops is not None:
+            return UNDO_ENTRY_OVERHEAD * (len(self.ops) + 1) + sum(len(op[2]) for op in self.ops)
+        if self.packed is not None:
+            return UNDO_ENTRY_OVERHEAD + len(self.packed)
+        return UNDO_ENTRY_OVERHEAD
+
+
+class UndoJournal:
+    """Undo/redo history that records edits rather than copies of the text.
+
+    Every entry holds the byte-level operations of one user action, as
+    ('i', offset, data) for an insert or ('d', offset, data) for a delete,
+    plus the cursor position before it. Undo replays the inverse operations
+    in reverse order and redo replays them forward, so the cost of an
+    entry depends only on the size of the edit.
+
+    A run of typed characters is merged into one insert operation, and
+    everything done inside transaction() becomes a single entry.
+
+    Memory is bounded: all but the newest UNDO_HOT_ENTRIES entries are
+    compressed, compressed entries are moved to a temporary file once the
+    journal uses more than memory_budget bytes, and entries beyond
+    max_depth are forgotten.
+
+    When a PersistentUndoLog is attached, save() writes the stack to it and
+    entries that are on disk no longer need to be kept in memory at all.
+    """
+
+    def __init__(self, memory_budget=UNDO_MEMORY_BUDGET, max_depth=UNDO_MAX_DEPTH):
+        self.memory_budget = memory_budget
+        self.max_depth = max_depth
+        self.undo_stack = []
+        self.redo_stack = []
+        self.memory = 0  # Approximate RAM used by both stacks
+        self.spilled = 0  # Bytes written to the spill file
+        self._spill_file = None
+        self._next_spill = 0  # undo_stack[:_next_spill] are all spilled
+        self._current = None
+        self._current_typing = False
+        self._cursor = (0, 0)
+        self._coalesce = False
+        self._depth = 0
+        self._replaying = False
+        self.log = None
+
+    def clear(self):
+        """Forgets all history and detaches the persistent log."""
+        self.undo_stack = []
+        self.redo_stack = []
+        self.memory = self.spilled = self._next_spill = 0
+        self._current = None
+        if self._spill_file:
+            self._spill_file.close()
+            self._spill_file = None
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    # --- Persistence ---
+
+    def attach(self, log, fingerprint):
+        """Uses log for this document. Returns the number of undo steps restored from it."""
+        self.clear()
+        self.log = log
+        for offset, y, x in log.load(fingerprint)[-self.max_depth:]:
+            entry = _UndoEntry((y, x))
+            entry.ops = None
+            entry.disk = offset
+            self.undo_stack.append(entry)
+            self.memory += entry.memory()
+        self._next_spill = len(self.undo_stack)
+        return len(self.undo_stack)
+
+    def _read_back_log(self):
+        """Brings every entry stored in the log back into memory."""
+        for entry in self.undo_stack + self.redo_stack:
+            if entry.disk is not None:
+                if entry.ops is None:
+                    entry.packed = zlib.compress(marshal.dumps(self.log.read_entry(entry.disk)), 1)
+                    self.memory += len(entry.packed)
+                entry.disk = None
+        self._next_spill = 0
+
+    def relocate(self, log):
+        """Moves the history to a new log, e.g. after Save As."""
+        self._read_back_log()
+        if self.log:
+            self.log.close()
+        self.log = log
+
+    def save(self, fingerprint):
+        """Writes the undo stack to the log as the history of the content with this fingerprint."""
+        if self.log is None:
+            return
+        # Typing after a save starts a new entry rather than changing a stored one
+        self._current = None
+        try:
+            if not self.undo_stack:
+                # Nothing to restore next session, so leave no file behind
+                self._read_back_log()
+                self.log.remove()
+                return
+            pending = [entry for entry in self.undo_stack if entry.disk is None]
+            offsets = self.log.append_entries(self._load(entry) for entry in pending)
+            for entry, offset in zip(pending, offsets):
+                entry.disk = offset
+            if self.log.needs_compaction():
+                live = [entry for entry in self.undo_stack + self.redo_stack if entry.disk is not None]
+                for entry, offset in zip(live, self.log.compact([entry.disk for entry in live])):
+                    entry.disk = offset
+            self.log.checkpoint([[entry.disk, *entry.cursor] for entry in self.undo_stack], fingerprint)
+        except OSError:
+            # Read-only directory or similar: keep the history in memory only
+            self.log.close()
+            self.log = None
+            return
+        # Everything but the hot entries can now be read back from the log
+        for entry in self.undo_stack[:-UNDO_HOT_ENTRIES]:
+            self.memory -= entry.memory()
+            entry.ops = entry.packed = entry.spill = None
+            self.memory += entry.memory()
+        self._next_spill = max(0, len(self.undo_stack) - UNDO_HOT_ENTRIES)
+
+    def begin(self, cursor, coalesce=False):
+        """Starts a new entry; it is only stored once it records an edit.
+
+        With coalesce=True (typing) the edit may instead extend the previous
+        entry, if that was typing too and the new text continues it.
+        Inside a transaction this does nothing.
+        """
+        if self._depth:
+            return
+        self._cursor = cursor
+        self._coalesce = coalesce and self._current is not None and self._current_typing
+        if not self._coalesce:
+            self._current = None
+            self._current_typing = coalesce
+
+    @contextmanager
+    def transaction(self, cursor):
+        """Groups every edit made inside the block into one undo entry."""
+        self.begin(cursor)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+
+    def record(self, kind, offset, data):
+        """Buffer listener: adds one operation to the current entry."""
+        if self._replaying:
+            return
+        self._clear_redo()
+        if self._coalesce:
+            self._coalesce = False
+            last_kind, last_offset, last_data = self._current.ops[-1]
+            if kind == 'i' == last_kind and offset == last_offset + len(last_data) and b'\n' not in data:
+                self._current.ops[-1] = ('i', last_offset, last_data + data)
+                self.memory += len(data)
+                return
+            self._current = None
+        if self._current is None:
+            self._current = _UndoEntry(self._cursor)
+            self.undo_stack.append(self._current)
+            self.memory += UNDO_ENTRY_OVERHEAD
+        self._current.ops.append((kind, offset, data))
+        self.memory += UNDO_ENTRY_OVERHEAD + len(data)
+        if len(self._current.ops) == 1:
+            self._trim()
+
+    def _clear_redo(self):
+        # Any new action clears the redo stack
+        for entry in self.redo_stack:
+            self.memory -= entry.memory()
+        self.redo_stack = []
+
+    # --- Memory management ---
+
+    def _trim(self):
+        """Applies the depth limit, compression and the memory budget."""
+        while len(self.undo_stack) > self.max_depth:
+            self.memory -= self.undo_stack.pop(0).memory()
+            self._next_spill = max(0, self._next_spill - 1)
+        # Keep the newest entries ready to replay and compress the rest
+        i = len(self.undo_stack) - UNDO_HOT_ENTRIES - 1
+        while i >= 0 and self.undo_stack[i].ops is not None:
+            self._pack(self.undo_stack[i])
+            i -= 1
+        # Over budget: move compressed entries to disk, oldest first
+        while self.memory > self.memory_budget and self._next_spill < len(self.undo_stack) - UNDO_HOT_ENTRIES:
+            self._spill(self.undo_stack[self._next_spill])
+            self._next_spill += 1
+
+    def _pack(self, entry):
+        before = entry.memory()
+        if entry.disk is None:
+            entry.packed = zlib.compress(marshal.dumps(entry.ops), 1)
+        entry.ops = None
+        self.memory += entry.memory() - before
+
+    def _spill(self, entry):
+        if entry.ops is not None:
+            self._pack(entry)
+        if entry.packed is None:
+            return  # Already on disk
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix="te_undo_")
+        self._spill_file.seek(0, os.SEEK_END)
+        entry.spill = (self._spill_file.tell(), len(entry.packed))
+        self._spill_file.write(entry.packed)
+        self.spilled += len(entry.packed)
+        self.memory -= len(entry.packed)
+        entry.packed = None
+
+    def _load(self, entry):
+        """Returns the operations of an entry in whatever form it is stored."""
+        if entry.ops is not None:
+            return entry.ops
+        if entry.disk is not None:
+            return self.log.read_entry(entry.disk)
+        packed = entry.packed
+        if packed is None:
+            offset, length = entry.spill
+            self._spill_file.seek(offset)
+            packed = self._spill_file.read(length)
+        return marshal.loads(zlib.decompress(packed))
+
+    # --- Undo/redo ---
+
+    def _replay(self, buffer, ops, inverse):
+        self._replaying = True
+        try:
+            for kind, offset, data in (reversed(ops) if inverse else ops):
+                if (kind == 'i') == inverse:
+                    buffer.delete_bytes(offset, len(data))
+                else:
+                    buffer.insert_bytes(offset, data)
+        finally:
+            self._replaying = False
+
+    def undo(self, buffer):
+        """Reverts the last entry. Returns the cursor to restore, or None if there is nothing to undo."""
+        self._current = None
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self._next_spill = min(self._next_spill, len(self.undo_stack))
+        self._replay(buffer, self._load(entry), inverse=True)
+        self.redo_stack.append(entry)
+        return entry.cursor
+
+    def redo(self, buffer):
+        """Re-applies the last undone entry. Returns the cursor after it, or None."""
+        self._current = None
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        ops = self._load(entry)
+        self._replay(buffer, ops, inverse=False)
+        self.undo_stack.append(entry)
+        kind, offset, data = ops[-1]
+        return buffer.position_of(offset + len(data) if kind == 'i' else offset)
+
 
 class FileBrowser:
     def __init__(self, stdscr, start_dir=None):
@@ -110,6 +2123,8 @@ class FileBrowser:
             files = []
             
             for item in all_items:
+                if item.endswith((".te-undo", ".te-save")):
+                    continue  # Undo history kept next to edited files, and unfinished saves
                 full_path = os.path.join(self.current_dir, item)
                 if os.path.isdir(full_path):
                     dirs.append(f"[{item}]")  # Mark directories with brackets
@@ -239,49 +2254,38 @@ class FileBrowser:
         
         return True
     
-    def handle_key(self, key):
-        """Handle keyboard input for file browser"""
-        if key == curses.KEY_UP:
-            if self.selected_item > 0:
-                self.selected_item -= 1
-        elif key == curses.KEY_DOWN:
-            if self.selected_item < len(self.items) - 1:
-                self.selected_item += 1
-        elif key == curses.KEY_BACKSPACE or key == 127:
-            # Go to parent directory
-            parent_dir = os.path.dirname(self.current_dir)
-            if parent_dir != self.current_dir:  # Prevent infinite loop at root
-                self.current_dir = parent_dir
-                self.refresh_items()
-                self.selected_item = 0
-                self.top_item = 0
-        elif key in [ord('\n'), curses.KEY_ENTER]:  # Enter key
-            if self.items and self.selected_item < len(self.items):
-                selected = self.items[self.selected_item]
-                
-                if selected == "[..]":
-                    # Go to parent directory
-                    parent_dir = os.path.dirname(self.current_dir)
-                    if parent_dir != self.current_dir:
-                        self.current_dir = parent_dir
-                        self.refresh_items()
-                        self.selected_item = 0
-                        self.top_item = 0
-                elif selected.startswith("[") and selected.endswith("]"):
-                    # Directory selected
-                    dir_name = selected[1:-1]  # Remove brackets
-                    new_path = os.path.join(self.current_dir, dir_name)
-                    if os.path.isdir(new_path):
-                        self.current_dir = new_path
-                        self.refresh_items()
-                        self.selected_item = 0
-                        self.top_item = 0
-                else:
-                    # File selected - return the full path
-                    return os.path.join(self.current_dir, selected)
-        elif key == 27:  # Escape key
-            return "CANCEL"
-        
+    def move(self, delta):
+        """Moves the selection up (negative delta) or down the list."""
+        self.selected_item = max(0, min(len(self.items) - 1, self.selected_item + delta))
+
+    def parent(self):
+        """Goes to the parent directory."""
+        parent_dir = os.path.dirname(self.current_dir)
+        if parent_dir != self.current_dir:  # Prevent infinite loop at root
+            self.current_dir = parent_dir
+            self.refresh_items()
+            self.selected_item = 0
+            self.top_item = 0
+
+    def select(self):
+        """Opens the selected directory, or returns the full path of the selected file."""
+        if self.items and self.selected_item < len(self.items):
+            selected = self.items[self.selected_item]
+            
+            if selected == "[..]":
+                self.parent()
+            elif selected.startswith("[") and selected.endswith("]"):
+                # Directory selected
+                dir_name = selected[1:-1]  # Remove brackets
+                new_path = os.path.join(self.current_dir, dir_name)
+                if os.path.isdir(new_path):
+                    self.current_dir = new_path
+                    self.refresh_items()
+                    self.selected_item = 0
+                    self.top_item = 0
+            else:
+                # File selected - return the full path
+                return os.path.join(self.current_dir, selected)
         return None
     
     def handle_mouse(self, mx, my):
@@ -300,13 +2304,265 @@ class FileBrowser:
             if 0 <= clicked_item < len(self.items):
                 if clicked_item == self.selected_item:
                     # Double-click effect - select the item
-                    return self.handle_key(ord('\n'))
+                    return self.select()
                 else:
                     # Single click - just select
                     self.selected_item = clicked_item
         
         return None
 
+# Key bindings for each input mode, compiled from key names to curses key
+# codes so a key is dispatched with one dict lookup. A key name is a curses
+# constant ("KEY_F2"), a single character, "^X" for Ctrl+X (X is a letter or
+# one of @ [ \ ] ^ _ ?, as in a terminal), or a raw key code ("459"). User
+# bindings in KEYMAP_FILE are merged over DEFAULT_KEYMAP, for example
+# {"editor": {"^S": "save", "KEY_F2": null}}; null unbinds a key. A command
+# can only be bound in the modes it works in (see modes_of). Unknown modes,
+# keys and commands are reported in errors, not raised.
+class Keymap:
+    def __init__(self, commands, bindings=None, path=None):
+        self.tables = {mode: {} for mode in DEFAULT_KEYMAP}
+        self.errors = []
+        self._commands = commands
+        self.bind(DEFAULT_KEYMAP if bindings is None else bindings)
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    user_bindings = json.load(f)
+                if not isinstance(user_bindings, dict):
+                    raise ValueError("expected an object of modes")
+            except (OSError, ValueError) as e:
+                self.errors.append(f"{os.path.basename(path)}: {e}")
+            else:
+                self.bind(user_bindings)
+
+    @staticmethod
+    def key_code(name):
+        """Returns the curses key code for a key name, or None if it is not one."""
+        if name.startswith("KEY_"):
+            code = getattr(curses, name, None)
+            return code if isinstance(code, int) else None
+        if len(name) == 1:
+            return ord(name)
+        if len(name) == 2 and name[0] == "^":
+            char = name[1].upper()
+            # Only these have a control code; "^1" is not a key
+            if char == "?" or "@" <= char <= "_":
+                return ord(char) ^ 0x40  # ^? is 127
+            return None
+        if name.isdigit():
+            return int(name)
+        return None
+
+    @staticmethod
+    def modes_of(command):
+        """Returns the modes a command can be bound in.
+
+        menu_, browser_ and context_ commands act on their own widget, which
+        only exists in that mode; the rest act on the text.
+        """
+        for prefix, mode in (("menu_", "menu"), ("browser_", "browser"), ("context_", "context_menu")):
+            if command.startswith(prefix):
+                return (mode,)
+        if command in ("escape", "toggle_menu"):
+            return ("editor", "menu")
+        return ("editor",)
+
+    def bind(self, bindings):
+        for mode, keys in bindings.items():
+            table = self.tables.get(mode)
+            if table is None or not isinstance(keys, dict):
+                self.errors.append(f"unknown mode {mode!r}")
+                continue
+            for name, command in keys.items():
+                code = self.key_code(name)
+                if code is None:
+                    self.errors.append(f"unknown key {name!r}")
+                elif command is None:
+                    table.pop(code, None)
+                elif not isinstance(command, str) or command not in self._commands:
+                    self.errors.append(f"unknown command {command!r}")
+                elif mode not in self.modes_of(command):
+                    self.errors.append(f"{command!r} cannot be bound in {mode!r}")
+                else:
+                    table[code] = command
+
+    def lookup(self, mode, key):
+        return self.tables[mode].get(key)
+
+
+# Puts the main loop to sleep until the editor has something to do: terminal
+# input, a resize (SIGWINCH), a background result or a timer. Threads and the
+# signal handler wake it by writing a byte to a pipe that select() watches
+# along with stdin. On Windows, where select() only takes sockets, it waits
+# in getch() instead and checks for background results every
+# EVENT_POLL_INTERVAL seconds.
+class EventLoop:
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.timers = []  # Heap of (deadline, sequence, callback)
+        self.resized = False
+        self.pending = bytearray()  # Input read from stdin ahead of curses
+        self._keys = deque()  # Keys put back by unget_keys
+        self._sequences = None  # (bytes, key) for the terminal's special keys, longest first
+        self._sequence = 0
+        self._pipe = None
+        if os.name != 'nt':
+            self._pipe = os.pipe()
+            for fd in self._pipe:
+                os.set_blocking(fd, False)
+            try:
+                # Python's handler replaces curses' own, so resizes are applied by resize()
+                signal.signal(signal.SIGWINCH, lambda signum, frame: None)
+                signal.set_wakeup_fd(self._pipe[1])
+            except ValueError:
+                pass  # Not the main thread: resizes arrive as KEY_RESIZE instead
+
+    def wakeup(self):
+        """Wakes the main loop. Safe to call from any thread."""
+        if self._pipe:
+            try:
+                os.write(self._pipe[1], b'\0')
+            except BlockingIOError:
+                pass  # The pipe is full, so a wakeup is already pending
+
+    def call_later(self, delay, callback):
+        """Runs callback from the main loop after delay seconds."""
+        self._sequence += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self._sequence, callback))
+
+    def wait(self):
+        """Sleeps until there is input, a wakeup or a timer is due.
+
+        Returns True if a timer ran, since the screen may need a redraw.
+        """
+        timeout = None
+        if self._keys or self.pending:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.monotonic())
+        if self._pipe:
+            try:
+                readable = select.select([sys.stdin, self._pipe[0]], [], [], timeout)[0]
+            except InterruptedError:
+                readable = []
+            if self._pipe[0] in readable:
+                try:
+                    data = os.read(self._pipe[0], 4096)
+                except BlockingIOError:
+                    data = b''
+                if bytes([signal.SIGWINCH]) in data:
+                    self.resized = True
+        else:
+            if timeout is None or timeout > EVENT_POLL_INTERVAL:
+                timeout = EVENT_POLL_INTERVAL
+            self.stdscr.timeout(int(timeout * 1000))
+            key = self.stdscr.getch()
+            self.stdscr.nodelay(1)
+            if key != -1:
+                self._keys.append(key)
+
+        ran = False
+        while self.timers and self.timers[0][0] <= time.monotonic():
+            heapq.heappop(self.timers)[2]()
+            ran = True
+        return ran
+
+    def get_key(self):
+        """Returns the next key like getch(), or -1 if there is none.
+
+        Keys put back with unget_keys come first, then the keys in pending.
+        Those bytes were read past a paste's end marker, so their special
+        key sequences are translated here instead of by curses.
+        """
+        if self._keys:
+            return self._keys.popleft()
+        if not self.pending:
+            return self.stdscr.getch()
+        data = self.pending
+        if data[0] == 27:
+            for sequence, key in self._key_sequences():
+                if data.startswith(sequence):
+                    del data[:len(sequence)]
+                    return key
+        key = data[0]
+        del data[:1]
+        return key
+
+    def unget_keys(self, keys):
+        """Puts keys back, so get_key returns them before any other input."""
+        self._keys.extendleft(reversed(keys))
+
+    def _key_sequences(self):
+        if self._sequences is None:
+            self._sequences = []
+            for name, key in KEY_CAPABILITIES.items():
+                try:
+                    sequence = curses.tigetstr(name)
+                except curses.error:
+                    sequence = None
+                if sequence and sequence.startswith(b'\x1b'):
+                    self._sequences.append((sequence, key))
+            self._sequences.sort(key=lambda item: len(item[0]), reverse=True)
+        return self._sequences
+
+    @property
+    def paste_supported(self):
+        # A paste is read straight from stdin, which needs select()
+        return self._pipe is not None
+
+    def set_bracketed_paste(self, enabled):
+        """Asks the terminal to mark pasted text, or to stop."""
+        if self.paste_supported:
+            sys.stdout.write("\x1b[?2004h" if enabled else "\x1b[?2004l")
+            sys.stdout.flush()
+
+    def read_paste(self):
+        """Reads the rest of a bracketed paste once its start marker was seen.
+
+        The text is taken from pending, then read from stdin in large blocks
+        rather than key by key. What follows the end marker is left in
+        pending for get_key. Returns the pasted bytes.
+        """
+        fd = sys.stdin.fileno()
+        data, self.pending = self.pending, bytearray()
+        searched = 0
+        while True:
+            end = data.find(PASTE_END, searched)
+            if end >= 0:
+                self.pending = data[end + len(PASTE_END):]
+                return bytes(data[:end])
+            searched = max(0, len(data) - len(PASTE_END) + 1)
+            if not select.select([fd], [], [], PASTE_TIMEOUT)[0]:
+                return bytes(data)  # The end marker never came
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                return bytes(data)
+            data += chunk
+
+    def resize(self):
+        """Applies a pending terminal resize. Returns True if there was one."""
+        if not self.resized:
+            return False
+        self.resized = False
+        try:
+            columns, lines = os.get_terminal_size(sys.__stdout__.fileno())
+            curses.resizeterm(lines, columns)
+        except (OSError, curses.error):
+            pass
+        return True
+
+    def close(self):
+        if self._pipe:
+            try:
+                signal.set_wakeup_fd(-1)
+            except ValueError:
+                pass
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+
+
 class Menu:
     def __init__(self, items):
         self.items = items
@@ -316,7 +2572,7 @@ class Menu:
         self.submenus = {
             "File": ["New", "Open", "Save", "Save as", "Exit"],            
             "Edit": ["Undo", "Redo", "Cut", "Copy", "Paste"],
-            "Menu": ["Toggle Line Numbers", "Change Theme"],
+            "Menu": ["Toggle Line Numbers", "Change Theme", "Detect Syntax"],
             "Help": ["User Manual", "About"]
         }
 
@@ -389,63 +2645,68 @@ class Menu:
                 return f"{self.items[self.current_item]}:{submenu_items[clicked_item_idx]}"
         return None
 
-    def handle_key(self, key):
-        # Keyboard navigation
-        if key == ord('\n'):
-            if self.open:
-                submenu_items = self.submenus[self.items[self.current_item]]
-                # Return the currently selected submenu item
-                return f"{self.items[self.current_item]}:{submenu_items[self.current_submenu_item]}"
-            else:
-                self.open = True
-                self.current_submenu_item = 0  # Reset submenu selection when opening
-        elif key == curses.KEY_LEFT:
-            if self.open:
-                # Navigate to previous menu item and reset submenu selection
-                self.current_item = (self.current_item - 1) % len(self.items)
-                self.current_submenu_item = 0
-            else:
-                self.current_item = (self.current_item - 1) % len(self.items)
-        elif key == curses.KEY_RIGHT:
-            if self.open:
-                # Navigate to next menu item and reset submenu selection
-                self.current_item = (self.current_item + 1) % len(self.items)
-                self.current_submenu_item = 0
-            else:
-                self.current_item = (self.current_item + 1) % len(self.items)
-        elif key == curses.KEY_UP and self.open:
-            # Navigate up in submenu
-            submenu_items = self.submenus[self.items[self.current_item]]
-            self.current_submenu_item = (self.current_submenu_item - 1) % len(submenu_items)
-        elif key == curses.KEY_DOWN and self.open:
-            # Navigate down in submenu
+    # Keyboard navigation
+    def select(self):
+        """Opens the current menu, or returns the chosen "Menu:Item" action if it is open."""
+        if self.open:
             submenu_items = self.submenus[self.items[self.current_item]]
-            self.current_submenu_item = (self.current_submenu_item + 1) % len(submenu_items)
-        elif key == 27:  # ESC key - close menu
-            self.open = False
-            return "CLOSE_MENU"  # Special signal to close menu
-        
+            # Return the currently selected submenu item
+            return f"{self.items[self.current_item]}:{submenu_items[self.current_submenu_item]}"
+        self.open = True
+        self.current_submenu_item = 0  # Reset submenu selection when opening
         return None
 
+    def move(self, delta):
+        """Moves to the previous (negative delta) or next menu."""
+        self.current_item = (self.current_item + delta) % len(self.items)
+        if self.open:
+            # Reset submenu selection when switching menus
+            self.current_submenu_item = 0
+
+    def move_submenu(self, delta):
+        """Moves up (negative delta) or down the open submenu."""
+        if self.open:
+            submenu_items = self.submenus[self.items[self.current_item]]
+            self.current_submenu_item = (self.current_submenu_item + delta) % len(submenu_items)
+
+    def close(self):
+        self.open = False
+        return "CLOSE_MENU"  # Special signal to close menu
+
 class TextEditor:
     def __init__(self, stdscr):
         self.stdscr = stdscr
-        self.content = ['']
+        self.buffer = PieceTable()
+        self.indexer = None  # Background LineIndexer for memory-mapped files
         self.cursor_y = 0
         self.cursor_x = 0
         self.top_line = 0
         self.left_col = 0 # Horizontal scrolling
         self.current_file = None
+        self.events = EventLoop(stdscr)
+        self._message_serial = 0  # Counts messages, so a timeout only clears its own
         self.message = ""
         self.color_theme = "default"
         self.menu = Menu(["File", "Edit", "Menu", "Help"])
         self.show_line_numbers = False
         self.menu_focus = False
         self.formatter = None
+        self.lexer = get_lexer_by_name("text")
+        self._lexer_key = None  # Extension the current lexer was resolved for, None when plain
+        self.highlight_worker = HighlightWorker(self.events.wakeup)
+        self.highlight_worker.start()
+        self.highlighter = SyntaxHighlighter(self.lexer, self.highlight_worker)
+        self.token_cache = TokenCache()
+        self.damage = ScreenDamage()
+        self.keymap = Keymap(self.COMMANDS, path=KEYMAP_FILE)
+        if self.keymap.errors:
+            self.message = "Keymap: " + "; ".join(self.keymap.errors)
         self.file_browser = None
         self.browser_mode = False
         self.selection_start = None
         self.selection_end = None
+        self._selection = Selection()
+        self._selection_endpoints = (None, None)
         
         #Initialize prev_key and a counter for the escape sequence
         self.escape_counter = 0
@@ -456,12 +2717,11 @@ class TextEditor:
         self.context_menu_items = ["Undo", "Redo", "Cut", "Copy", "Paste"]
         self.selected_context_menu_item = 0
 
-        # State for Undo/Redo functionality
-        self.history = []
-        self.redo_stack = []
+        # Undo/Redo journal, fed by the buffer's edit listener
+        self.journal = UndoJournal()
+        self.buffer.listener = self._buffer_edited
 
         self.read_only = False
-        self._save_state() # Save the initial empty state
 
     def setup_colors(self):
         """Sets up colors for syntax highlighting"""
@@ -469,6 +2729,7 @@ class TextEditor:
         curses.use_default_colors()
         self.formatter = CursesFormatter(style=self.color_theme)
         self.formatter.setup_colors()
+        self.damage.invalidate()
 
         # --- Set the window's background color ---
         try:
@@ -480,39 +2741,146 @@ class TextEditor:
             # Fallback if the style is unusual
             self.stdscr.bkgd(' ', curses.A_NORMAL)
 
+    def update_lexer(self, redetect=False):
+        """Resolves the syntax highlighting lexer for the current file.
+
+        Lexers are cached per file extension, so Pygments only guesses when
+        a file type is seen for the first time or when redetect is True.
+        """
+        name = os.path.basename(self.current_file or 'text.txt')
+        key = os.path.splitext(name)[1].lower() or name
+        if self.current_file is None or not self.buffer.complete or len(self.buffer) >= PLAIN_TEXT_THRESHOLD:
+            # Untitled, oversized and still indexing buffers take the plain
+            # text path. That is decided per buffer, so it is not remembered
+            # for the extension; an indexed file is resolved again when done.
+            self._lexer_key = None
+            lexer = get_lexer_by_name("text")
+        elif key == self._lexer_key and not redetect:
+            return
+        else:
+            self._lexer_key = key
+            lexer = None if redetect else _LEXER_CACHE.get(key)
+        if lexer is None:
+            sample_end = min(self.buffer.line_count(), LEXER_SAMPLE_LINES)
+            sample = "\n".join(self.buffer.get_line(y) for y in range(sample_end))
+            try:
+                lexer = guess_lexer_for_filename(name, sample)
+            except:
+                lexer = get_lexer_by_name("text")
+            _LEXER_CACHE[key] = lexer
+        self.lexer = lexer
+        self.highlighter.close()
+        self.highlighter = SyntaxHighlighter(lexer, self.highlight_worker)
+
     def run(self):
         # Initial setup
         curses.mousemask(curses.ALL_MOUSE_EVENTS | curses.REPORT_MOUSE_POSITION)
         self.stdscr.nodelay(1)
+        # Let curses scroll the terminal for scrl() rather than redraw the rows
+        self.stdscr.idlok(True)
 
         # Enable raw mode to capture Ctrl+C
         curses.raw()
 
         self.setup_colors()
+        self.events.set_bracketed_paste(True)
+        try:
+            self._main_loop()
+        finally:
+            self.events.set_bracketed_paste(False)
 
+    def _main_loop(self):
+        changed = True
         while True:
-            # Hide cursor if in menu or browser mode, otherwise show it.
-            if self.menu_focus or self.browser_mode or self.context_menu_active:
-                curses.curs_set(0)
-            else:
-                curses.curs_set(1)
+            # Redraw only after something happened: a key, a resize, a timer or a background result
+            if changed:
+                # Hide cursor if in menu or browser mode, otherwise show it.
+                if self.menu_focus or self.browser_mode or self.context_menu_active:
+                    curses.curs_set(0)
+                else:
+                    curses.curs_set(1)
 
-            # Main draw loop
-            if self.browser_mode:
-                self.draw_browser_interface()
-            else:
-                self.draw_interface()
+                # Main draw loop
+                if self.browser_mode:
+                    self.draw_browser_interface()
+                else:
+                    self.draw_interface()
 
-            # Refresh screen before handling input
-            self.stdscr.refresh()
+                # Refresh screen before handling input
+                self.stdscr.refresh()
 
             # Handle user input
-            self.handle_input()
-            curses.napms(10)
+            changed = self.handle_input()
+            changed |= self.events.resize()
+            changed |= self._poll_indexer()
+            changed |= self._poll_highlighter()
+            if not changed:
+                # Nothing to do: sleep until there is
+                changed = self.events.wait()
+
+    @property
+    def message(self):
+        """The status bar message. Each new one is cleared after STATUS_MESSAGE_TIMEOUT seconds."""
+        return self._message
+
+    @message.setter
+    def message(self, text):
+        self._message = text
+        self._message_serial += 1
+        if text:
+            serial = self._message_serial
+            self.events.call_later(STATUS_MESSAGE_TIMEOUT, lambda: self._expire_message(serial))
+
+    def _expire_message(self, serial):
+        if serial == self._message_serial:
+            self.message = ""
+
+    def _poll_indexer(self):
+        """Applies newline offsets found by the background indexer to the buffer.
+
+        Returns True if there were any.
+        """
+        if not self.indexer:
+            return False
+        applied = False
+        while True:
+            try:
+                result = self.indexer.results.get_nowait()
+            except queue.Empty:
+                break
+            applied = True
+            if result[0] == 'lines':
+                _, offsets, scanned = result
+                self.buffer.extend_index(offsets, scanned)
+                percent = scanned * 100 // max(len(self.buffer), 1)
+                self.message = f"Indexing {os.path.basename(self.current_file)}: {percent}% (read-only until done)"
+            else:
+                _, encoding, fingerprint = result
+                self.buffer.finish_index(encoding)
+                self.indexer = None
+                label = "UTF-8" if encoding == 'utf-8' else "Decoded as Latin-1"
+                self.message = f"Opened {self.current_file} ({label}, {self.buffer.line_count()} lines)"
+                self.update_lexer()  # Held at plain text while the file was indexing
+                self._attach_undo_log(fingerprint)
+                break
+        return applied
+
+    def _poll_highlighter(self):
+        """Commits lines lexed by the highlighting worker. Returns True if there were any."""
+        applied = False
+        while True:
+            try:
+                job, lines = self.highlight_worker.results.get_nowait()
+            except queue.Empty:
+                break
+            self.highlighter.apply(self.buffer, job, lines)
+            applied = True
+        return applied
 
     def draw_browser_interface(self):
         """Draw the file browser interface"""
         self.stdscr.erase()
+        self.damage.invalidate()  # The editor is repainted in full when the browser closes
         
         if self.file_browser and self.file_browser.draw():
             pass  # Browser drew successfully
@@ -527,11 +2895,18 @@ class TextEditor:
         self.stdscr.refresh()
 
     def draw_interface(self):
-        self.stdscr.erase()
         height, width = self.stdscr.getmaxyx()
+        self.damage.repainted = 0
+        if self.damage.size != (height, width):
+            # First frame, or the terminal was resized: start from a blank screen
+            self.stdscr.erase()
+            self.damage.invalidate()
+            self.damage.size = (height, width)
         
         # Ensure minimum terminal size
         if height < 6 or width < 20:
+            self.stdscr.erase()
+            self.damage.invalidate()
             try:
                 self.stdscr.addstr(0, 0, "Terminal too small.")
                 self.stdscr.refresh()
@@ -544,22 +2919,39 @@ class TextEditor:
         # Draw content with syntax highlighting
         self.draw_content(height, width, line_num_width)
         
-        # Draw menu over the content
-        self.menu.display(self.stdscr, 0, 0)
-
+        # Draw menu over the content. Rows under an open dropdown or context
+        # menu are forgotten, so the content is repainted once they close.
+        menu_key = (self.menu.current_item, self.menu.open, self.menu.current_submenu_item)
+        if self.damage.changed(0, menu_key) or self.menu.open:
+            self.stdscr.move(0, 0)
+            self.stdscr.clrtoeol()
+            self.menu.display(self.stdscr, 0, 0)
+        if self.menu.open:
+            submenu = self.menu.submenus[self.menu.items[self.menu.current_item]]
+            self.damage.forget(*range(1, len(submenu) + 1))
 
         # Draw the context menu if it is active
         if self.context_menu_active:
             self.draw_context_menu()
+            menu_y = self.context_menu_pos[0]
+            self.damage.forget(*range(menu_y, menu_y + len(self.context_menu_items)))
 
         # Draw status bars
-        status = f"File: {self.current_file or 'Untitled'} | Ln {self.cursor_y + 1}, Col {self.cursor_x + 1} | Theme: {self.color_theme}"
+        line_info = f"Ln {self.cursor_y + 1}"
+        if not self.buffer.complete:
+            # The total is only a lower bound until the index is final
+            line_info += f"/≥{self.buffer.line_count()}"
+        status = (f"File: {self.current_file or 'Untitled'} | {line_info}, Col {self.cursor_x + 1} | "
+                  f"Theme: {self.color_theme} | Undo: {format_size(self.journal.memory)}")
+        if self.plain_text():
+            status += " | Plain text"
 
         if self.menu_focus:
             help_text = "MENU MODE: ←→ Select Menu | ↑↓ Navigate Items | Enter: Select | Esc: Close | F9: Edit Mode | Click text to edit"
         else:
             help_text = "F1: Open | F2: Save | F3: New | F4: Theme | F5: Line Num | F9: Menu | Esc x3: Quit"
         
+        status_changed = False
         try:
             self.stdscr.attron(curses.A_REVERSE)
 
@@ -570,19 +2962,20 @@ class TextEditor:
                 message_line = (self.message[:width-1] if len(self.message) >= width else self.message).ljust(width - 1)
                 help_line = (help_text[:width-1] if len(help_text) >= width else help_text).ljust(width - 1)
 
-                # Only draw if we have enough vertical space
-                if height >= 4:
+                # Only draw if we have enough vertical space, and only the bars that changed
+                status_changed = self.damage.changed(height - 3, (status_line, self.menu_focus))
+                if height >= 4 and status_changed:
                     self.stdscr.addstr(height - 3, 0, status_line)
-                if height >= 3:
+                if height >= 3 and self.damage.changed(height - 2, message_line):
                     self.stdscr.addstr(height - 2, 0, message_line)
-                if height >= 2:
+                if height >= 2 and self.damage.changed(height - 1, help_line):
                     self.stdscr.addstr(height - 1, 0, help_line)
 
             self.stdscr.attroff(curses.A_REVERSE)
 
             # Add mode indicator (also check width and height)
             #if width > 10 and height >= 4: # No need to check for width
-            if height >= 4:
+            if height >= 4 and status_changed:
                 mode = "Mode: MENU" if self.menu_focus else "Mode: EDIT"
                 mode_text = f" {mode} "
                 # Only draw the mode text if there is enough horizontal space for it.
@@ -664,10 +3057,18 @@ class TextEditor:
         if content_height <= 0 or width <= line_num_width:
             return
         
-        try:
-            lexer = guess_lexer_for_filename(self.current_file or 'text.txt', "".join(self.content))
-        except:
-            lexer = get_lexer_by_name("text")
+        # Highlight the visible lines; the worker fills them in over the next frames
+        plain = self.plain_text()
+        plain_attr = self.formatter.attr_for(Token.Text) if self.formatter else 0
+        if not plain:
+            self.highlighter.update(self.buffer, self.top_line, self.top_line + content_height - 1)
+
+        # Decode the visible lines plus a read-ahead window in one pass
+        self.buffer.prefetch(self.top_line - READ_AHEAD_LINES, self.top_line + content_height + READ_AHEAD_LINES)
+
+        # Shift the rows that stay visible after a scroll instead of repainting them
+        self.damage.scroll(self.stdscr, self.top_line, 1, content_height)
+        selection = self.selection()
 
         for i in range(content_height):
             line_idx = self.top_line + i
@@ -675,59 +3076,120 @@ class TextEditor:
             
             if screen_y >= height - 3:  # Stop drawing before status bars
                 break
-                
-            if line_idx < len(self.content):
-                try:
-                    if self.show_line_numbers and line_num_width <= width:
-                        self.stdscr.addstr(screen_y, 0, f"{line_idx + 1:4d} ", curses.A_DIM)
-                    
-                    line = self.content[line_idx]
-                    available_width = width - line_num_width - 1
-                    if available_width <= 0: 
-                        continue
 
-                    # Apply horizontal offset to the line
-                    visible_line = line[self.left_col:self.left_col + available_width + 100]
+            if line_idx >= self.buffer.line_count():
+                # Past the end of the document the row is blank
+                if self.damage.changed(screen_y, ""):
+                    self.stdscr.move(screen_y, 0)
+                    self.stdscr.clrtoeol()
+                continue
 
-                    # 1. Get a list of (text, attribute) tokens for visible items
-                    if self.formatter:
-                        token_stream = lex(visible_line, lexer)
-                        tokens = self.formatter.format(token_stream, None)
-                    else:
-                        # If no formatter, treat the whole line as one token with default attribute
-                        tokens = [(visible_line, 0)]
-
-                    # 2. Unified drawing loop that handles all cases
-                    x_pos = line_num_width
-                    line_x_pos = self.left_col # Tracks position in the actual line data
-
-                    for text, attr in tokens:
-                        if x_pos >= width - 1: 
-                            break
-
-                        # Truncate token text if it would go past the edge of the screen
-                        remaining_width = width - x_pos - 1
-                        display_text = text[:remaining_width]
-
-                        # Draw character by character to handle selection
-                        if display_text:
-                            for char_index, char_to_draw in enumerate(display_text):
-                                doc_char_x = line_x_pos + char_index
-                                
-                                final_attr = attr
-                                if self.is_selected(line_idx, doc_char_x):
-                                    final_attr |= curses.A_REVERSE # Add selection highlight
-
-                                self.stdscr.addstr(screen_y, x_pos + char_index, char_to_draw, final_attr)
-                            
-                            x_pos += len(display_text)
-                        
-                        # Always advance the document position by the original token length
-                        line_x_pos += len(text)
-                        
-                except curses.error:
+            try:
+                prefix = None
+                if self.show_line_numbers and line_num_width <= width:
+                    prefix = f"{line_idx + 1:4d} "
+                
+                available_width = width - line_num_width - 1
+                if available_width <= 0:
+                    tokens = []
+                # 1. Get a list of (text, attribute) tokens for visible items,
+                #    starting at the horizontal offset
+                elif plain:
+                    # Plain text: the visible slice is one token
+                    tokens = [(self.buffer.get_line(line_idx)[self.left_col:self.left_col + available_width], plain_attr)]
+                elif self.formatter:
+                    runs = self.highlighter.line_runs(self.buffer, line_idx)
+                    right_col = self.left_col + available_width + 100
+                    tokens = self._format_line(line_idx, runs, self.left_col, right_col)
+                else:
+                    # If no formatter, treat the whole line as one token with default attribute
+                    runs = self.highlighter.line_runs(self.buffer, line_idx)
+                    right_col = self.left_col + available_width + 100
+                    tokens = _clip_runs([(text, 0) for _, text in runs], self.left_col, right_col)
+
+                # 2. Skip the row if it would be drawn exactly as it already is
+                spans = selection.spans(line_idx)
+                if not self.damage.changed(screen_y, (prefix, self.left_col, tuple(tokens), spans)):
                     continue
+                self.stdscr.move(screen_y, 0)
+                self.stdscr.clrtoeol()
+                if prefix:
+                    self.stdscr.addstr(screen_y, 0, prefix, curses.A_DIM)
+
+                # 3. Draw the tokens, a few runs each
+                self._draw_tokens(screen_y, line_num_width, width, tokens, spans)
+
+            except curses.error:
+                continue
       
+    def _draw_tokens(self, screen_y, x_pos, width, tokens, spans):
+        """Draws tokens starting at column left_col of the line, with one addstr per run.
+
+        spans are the selected (start, end) column ranges of the line. Each
+        token is split into runs at their edges, so with one selection range
+        it takes at most three: before, inside and after it.
+        """
+        line_x_pos = self.left_col # Tracks position in the actual line data
+        for text, attr in tokens:
+            if x_pos >= width - 1:
+                break
+
+            # Truncate token text if it would go past the edge of the screen
+            display_text = text[:width - x_pos - 1]
+            if '\t' in display_text:
+                # A tab takes one column, as the cursor assumes
+                display_text = display_text.replace('\t', ' ')
+
+            drawn = 0
+            for start, end in spans:
+                start = max(start - line_x_pos, drawn)
+                end = min(end - line_x_pos, len(display_text))
+                if start >= end:
+                    continue
+                if start > drawn:
+                    self.stdscr.addstr(screen_y, x_pos + drawn, display_text[drawn:start], attr)
+                self.stdscr.addstr(screen_y, x_pos + start, display_text[start:end], attr | curses.A_REVERSE)
+                drawn = end
+            if drawn < len(display_text):
+                self.stdscr.addstr(screen_y, x_pos + drawn, display_text[drawn:], attr)
+
+            x_pos += len(display_text)
+            # Always advance the document position by the original token length
+            line_x_pos += len(text)
+
+    def plain_text(self):
+        """True when the buffer is drawn as plain text, without tokenizing."""
+        return isinstance(self.lexer, TextLexer) or len(self.buffer) >= PLAIN_TEXT_THRESHOLD
+
+    def _format_line(self, y, runs, left, right):
+        """Formats columns left..right of line y through the token cache.
+
+        Long lines are formatted and cached by (line, chunk), so only the
+        chunks on screen are ever formatted.
+        """
+        states = self.highlighter.line_states(y)
+        line_key = (self.lexer.name, self.color_theme, states, self.buffer.get_line(y)) if states else None
+        if not isinstance(runs, _LongLineRuns):
+            # Inside a multi-line token the runs themselves are the key
+            tokens = self._cached_format(line_key or (self.lexer.name, self.color_theme, tuple(runs)), runs)
+            return _clip_runs(tokens, left, right)
+        first = i = bisect_right(runs.chunk_columns, left) - 1
+        tokens = []
+        while i < len(runs.chunk_columns) and runs.chunk_columns[i] < right:
+            chunk = runs.chunk(i)
+            key = line_key + (i,) if line_key else (self.lexer.name, self.color_theme, tuple(chunk))
+            tokens.extend(self._cached_format(key, chunk))
+            i += 1
+        offset = runs.chunk_columns[first]
+        return _clip_runs(tokens, left - offset, right - offset)
+
+    def _cached_format(self, key, runs):
+        tokens = self.token_cache.get(key)
+        if tokens is None:
+            tokens = self.formatter.format(runs, None)
+            self.token_cache.put(key, tokens)
+        return tokens
+
     def open_user_manual(self):
         """Opens the user_manual.txt file in a new, read-only buffer."""
         try:
@@ -739,11 +3201,11 @@ class TextEditor:
                 self.message = "user_manual.txt not found."
                 return
 
-            with open(manual_path, 'r', encoding='utf-8') as f:
-                content_lines = f.read().splitlines()
+            with open(manual_path, 'rb') as f:
+                data = f.read()
 
             # Load the content into the editor
-            self.content = content_lines if content_lines else ['']
+            self._set_buffer(PieceTable(data))
             self.current_file = "User Manual (Read-Only)"
             self.cursor_y, self.cursor_x, self.top_line = 0, 0, 0
             
@@ -752,126 +3214,180 @@ class TextEditor:
             
             self.message = "Opened User Manual. Press F3 for a new file to exit."
             self.setup_colors()
+            self.update_lexer()
             
             # Clear history for this new buffer
-            self.history = []
-            self.redo_stack = []
-            self._save_state()
+            self.journal.clear()
 
         except Exception as e:
             self.message = f"Error opening manual: {e}"
 
     
 
-    def _save_state(self):
-        """Saves a snapshot of the current content with deepcopy for undo."""
-        snapshot = {
-            'content': copy.deepcopy(self.content),
-            'cursor_y': self.cursor_y,
-            'cursor_x': self.cursor_x
-        }
-        self.history.append(snapshot)
-        # Any new action clears the redo stack
-        self.redo_stack = []
+    def _save_state(self, coalesce=False):
+        """Starts a new undo entry; the edits that follow are recorded into it.
+        Typing passes coalesce=True so a run of characters undoes as one step."""
+        self.journal.begin((self.cursor_y, self.cursor_x), coalesce)
 
-    def _restore_state(self, state):
-        """Restores the editor's content and cursor from a snapshot."""
-        self.content = copy.deepcopy(state['content'])
-        self.cursor_y = state['cursor_y']
-        self.cursor_x = state['cursor_x']
+    def edit_transaction(self):
+        """Context manager that makes every edit in the block a single undo step."""
+        return self.journal.transaction((self.cursor_y, self.cursor_x))
+
+    def _restore_cursor(self, cursor):
+        """Moves the cursor to a position recorded by the journal."""
+        self.clear_selection()
+        self.cursor_y = min(cursor[0], self.buffer.line_count() - 1)
+        self.cursor_x = min(cursor[1], self.buffer.line_length(self.cursor_y))
         self._ensure_cursor_visible()
 
     def undo(self):
         """Performs an undo operation."""
-        if len(self.history) > 1: # Must be more than the initial state
-            # Save current state for a potential redo
-            current_state = self.history.pop()
-            self.redo_stack.append(current_state)
-            
-            # Restore the previous state
-            last_state = self.history[-1]
-            self._restore_state(last_state)
+        cursor = self.journal.undo(self.buffer)
+        if cursor is not None:
+            self._restore_cursor(cursor)
             self.message = "Undo performed."
         else:
             self.message = "Nothing to undo."
 
     def redo(self):
         """Performs a redo operation."""
-        if self.redo_stack:
-            state_to_restore = self.redo_stack.pop()
-            # Push this state back to the history so we can undo it again
-            self.history.append(state_to_restore)
-            self._restore_state(state_to_restore)
+        cursor = self.journal.redo(self.buffer)
+        if cursor is not None:
+            self._restore_cursor(cursor)
             self.message = "Redo performed."
         else:
             self.message = "Nothing to redo."
 
     def handle_input(self):
-        """Handle context menu state. If is active, capture..."""
-        if self.context_menu_active:
-            key = self.stdscr.getch()
-            if key == curses.KEY_MOUSE:
-                _, mx, my, _, bstate = curses.getmouse()
-                # Check if click is on a menu item
-                cy, cx = self.context_menu_pos
-                max_len = max(len(s) for s in self.context_menu_items) + 2
-                if cy <= my < cy + len(self.context_menu_items) and cx <= mx < cx + max_len:
-                    item_clicked = self.context_menu_items[my - cy]
-                    if item_clicked == "Copy": self.copy_text()
-                    elif item_clicked == "Cut": self.cut_text()
-                    elif item_clicked == "Paste": self.paste_text()
-                # Any click closes the menu
-                self.context_menu_active = False
-            elif key == 27: # Escape key
-                self.context_menu_active = False
-            return
+        """Handles every key that is waiting. Returns False if there was none.
+
+        The screen is drawn once per batch, and a run of characters typed
+        into the text is inserted with one buffer edit.
+        """
+        handled = False
+        typed = []
+        while True:
+            key = self.events.get_key()
+            if key == -1:
+                break
+            handled = True
+            if 32 <= key <= 126 and self.input_mode() == "editor" and self.keymap.lookup("editor", key) is None:
+                typed.append(chr(key))
+                continue
+            if typed:
+                self._insert_typed(typed)
+                typed = []
+            if key == 27 and self.events.paste_supported and self._read_paste_start():
+                self._paste_bracketed()
+                continue
+            self.handle_key(key)
+        if typed:
+            self._insert_typed(typed)
+        return handled
 
-        key = self.stdscr.getch()
-        if key == -1: return
+    def _insert_typed(self, chars):
+        self.escape_counter = 0
+        self.insert_char("".join(chars))
 
-        # New top-level check for browser mode
-        if self.browser_mode:
-            self.handle_browser_input(key)
-            return
+    def _read_paste_start(self):
+        """After an Escape, reads the rest of a paste start marker if that is what follows.
 
-        # The rest of the logic is for editor/menu mode
-        if key == 27:
-            if self.menu.open:
-                self.handle_menu_input(key)
-                return
-            self.escape_counter += 1
-            if self.escape_counter == 3:
-                sys.exit(0)
-            return
+        Keys that turn out not to be part of one are put back.
+        """
+        read = []
+        for expected in PASTE_START[1:]:
+            key = self.events.get_key()
+            if key == -1:
+                break
+            read.append(key)
+            if key != expected:
+                break
         else:
-            self.escape_counter = 0
+            return True
+        self.events.unget_keys(read)
+        return False
 
-        if key == curses.KEY_F9:
-            self.menu_focus = not self.menu_focus
-            self.message = "Menu navigation enabled." if self.menu_focus else "Text editing mode."
-            self.menu.open = False
+    def _paste_bracketed(self):
+        """Inserts text pasted through the terminal with one buffer edit and one undo step."""
+        # Keys typed after the paste stay in events.pending and are handled as usual
+        data = self.events.read_paste()
+        text = data.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+        if not text or self.browser_mode or self.menu_focus or self.context_menu_active:
             return
+        if self._check_read_only(): return
+        with self.edit_transaction():
+            if self.selection_start:
+                self.delete_selected_text()
+            self.cursor_y, self.cursor_x = self.buffer.insert(self.cursor_y, self.cursor_x, text)
+        self._ensure_cursor_visible()
+        lines = text.count('\n') + 1
+        self.message = f"Pasted {lines} lines."
 
-        if self.menu_focus:
-            self.handle_menu_input(key)
-        else:
-            self.handle_editor_input(key)
+    def input_mode(self):
+        """Returns the keymap mode that handles keys right now."""
+        if self.context_menu_active:
+            return "context_menu"
+        if self.browser_mode:
+            return "browser"
+        return "menu" if self.menu_focus else "editor"
 
-    def handle_browser_input(self, key):
-        if not self.file_browser:
+    def handle_key(self, key):
+        """Runs the command bound to key in the current mode's keymap."""
+        mode = self.input_mode()
+        if mode == "browser" and not self.file_browser:
             self.browser_mode = False # Safety exit
             return
-        
-        result = None
-        if key == curses.KEY_MOUSE:
-            try:
-                _, mx, my, _, _ = curses.getmouse()
-                result = self.file_browser.handle_mouse(mx, my)
-            except curses.error:
-                pass
-        else:
-            result = self.file_browser.handle_key(key)
+        command = self.keymap.lookup(mode, key)
+        if mode in ("editor", "menu") and command != "escape":
+            self.escape_counter = 0
+        if command is not None:
+            self.COMMANDS[command](self)
+        elif mode == "editor" and 32 <= key <= 126:
+            # Character input (also acts on selection)
+            self.insert_char(chr(key))
+
+    def _escape(self):
+        """Closes an open menu; otherwise three in a row quit."""
+        if self.menu.open:
+            self._menu_action(self.menu.close())
+            return
+        self.escape_counter += 1
+        if self.escape_counter == 3:
+            sys.exit(0)
 
+    def toggle_menu_focus(self):
+        self.menu_focus = not self.menu_focus
+        self.message = "Menu navigation enabled." if self.menu_focus else "Text editing mode."
+        self.menu.open = False
+
+    def toggle_line_numbers(self):
+        self.show_line_numbers = not self.show_line_numbers
+        self.message = f"Line numbers turned {'on' if self.show_line_numbers else 'off'}."
+
+    def _context_menu_mouse(self):
+        _, mx, my, _, bstate = curses.getmouse()
+        # Check if click is on a menu item
+        cy, cx = self.context_menu_pos
+        max_len = max(len(s) for s in self.context_menu_items) + 2
+        if cy <= my < cy + len(self.context_menu_items) and cx <= mx < cx + max_len:
+            item_clicked = self.context_menu_items[my - cy]
+            if item_clicked == "Copy": self.copy_text()
+            elif item_clicked == "Cut": self.cut_text()
+            elif item_clicked == "Paste": self.paste_text()
+        # Any click closes the menu
+        self.context_menu_active = False
+
+    def _close_context_menu(self):
+        self.context_menu_active = False
+
+    def _browser_mouse(self):
+        try:
+            _, mx, my, _, _ = curses.getmouse()
+            self._browser_result(self.file_browser.handle_mouse(mx, my))
+        except curses.error:
+            pass
+
+    def _browser_result(self, result):
         if result:
             self.browser_mode = False # Exit browser mode on any action
             self.file_browser = None  # Clean up the browser instance
@@ -881,40 +3397,38 @@ class TextEditor:
             else: # A filename was returned
                 self._load_file_content(result)
 
-    def handle_menu_input(self, key):
+    def _menu_mouse(self):
         action = None
-        if key == curses.KEY_MOUSE:
-            try:
-                _, mx, my, _, _ = curses.getmouse()
-                height, width = self.stdscr.getmaxyx()
+        try:
+            _, mx, my, _, _ = curses.getmouse()
+            height, width = self.stdscr.getmaxyx()
 
-                # --- MOUSE HANDLING ---
-                # First, let the Menu object try to handle the click.
-                action = self.menu.handle_mouse(mx, my)
+            # --- MOUSE HANDLING ---
+            # First, let the Menu object try to handle the click.
+            action = self.menu.handle_mouse(mx, my)
 
-                # If the menu didn't handle it, it was a click outside the menu.
-                if action is None:
-                    # Check if the click was in the text area.
-                    if my > 0 and my < height - 3:
-                        self.menu_focus = False
-                        self.menu.open = False
-                        self.message = "Returned to editing mode."
-                        # Place cursor at the clicked location
-                        line_num_width = 5 if self.show_line_numbers else 0
-                        clicked_y = min(max(0, self.top_line + my - 1), len(self.content) - 1)
-                        self.cursor_y = clicked_y
-                        if 0 <= clicked_y < len(self.content):
-                            self.cursor_x = min(max(0, mx - line_num_width), len(self.content[clicked_y]))
-                        else:
-                            self.cursor_x = 0
-                        self.clear_selection()
-                        return # Event handled, no more processing needed
-            except curses.error:
-                action = None
-        
-        elif key in [curses.KEY_LEFT, curses.KEY_RIGHT, curses.KEY_UP, curses.KEY_DOWN, ord('\n'), 27]:
-            action = self.menu.handle_key(key)
-        
+            # If the menu didn't handle it, it was a click outside the menu.
+            if action is None:
+                # Check if the click was in the text area.
+                if my > 0 and my < height - 3:
+                    self.menu_focus = False
+                    self.menu.open = False
+                    self.message = "Returned to editing mode."
+                    # Place cursor at the clicked location
+                    line_num_width = 5 if self.show_line_numbers else 0
+                    clicked_y = min(max(0, self.top_line + my - 1), self.buffer.line_count() - 1)
+                    self.cursor_y = clicked_y
+                    if 0 <= clicked_y < self.buffer.line_count():
+                        self.cursor_x = min(max(0, mx - line_num_width), self.buffer.line_length(clicked_y))
+                    else:
+                        self.cursor_x = 0
+                    self.clear_selection()
+                    return # Event handled, no more processing needed
+        except curses.error:
+            action = None
+        self._menu_action(action)
+
+    def _menu_action(self, action):
         if action:
             if action == "CLOSE_MENU":
                 self.menu.open = False
@@ -923,123 +3437,67 @@ class TextEditor:
             else:
                 self.handle_menu_action(action)
     
-    def handle_editor_input(self, key):
-        if key == curses.KEY_MOUSE:
-            try:
-                _, mx, my, _, bstate = curses.getmouse()
-                height, width = self.stdscr.getmaxyx()
-                
-                # Handle right-click to open context menu
-                if bstate & curses.BUTTON3_CLICKED or bstate & curses.BUTTON3_PRESSED:
-                    self.context_menu_active = True
-                    # Clamp menu position to stay on screen
-                    menu_width = max(len(s) for s in self.context_menu_items) + 2
-                    menu_y = my
-                    if menu_y + len(self.context_menu_items) >= height - 2:
-                         menu_y = height - 3 - len(self.context_menu_items)
-                    menu_x = mx
-                    if menu_x + menu_width >= width:
-                        menu_x = width - menu_width - 1
-                    self.context_menu_pos = (max(0, menu_y), max(0, menu_x))
-                    return
+    def _editor_mouse(self):
+        try:
+            _, mx, my, _, bstate = curses.getmouse()
+            height, width = self.stdscr.getmaxyx()
+            
+            # Handle right-click to open context menu
+            if bstate & curses.BUTTON3_CLICKED or bstate & curses.BUTTON3_PRESSED:
+                self.context_menu_active = True
+                # Clamp menu position to stay on screen
+                menu_width = max(len(s) for s in self.context_menu_items) + 2
+                menu_y = my
+                if menu_y + len(self.context_menu_items) >= height - 2:
+                     menu_y = height - 3 - len(self.context_menu_items)
+                menu_x = mx
+                if menu_x + menu_width >= width:
+                    menu_x = width - menu_width - 1
+                self.context_menu_pos = (max(0, menu_y), max(0, menu_x))
+                return
 
-                # Handle left-click actions in the content area
-                if my > 0 and my < height - 2:
-                    line_num_width = 5 if self.show_line_numbers else 0
-                    clicked_y = min(max(0, self.top_line + my - 1), len(self.content) - 1)
-                    clicked_x = min(max(0, mx - line_num_width), len(self.content[clicked_y]))
-
-                    if bstate & curses.BUTTON1_CLICKED or bstate & curses.BUTTON1_PRESSED:
-                        self.clear_selection()
-                        self.cursor_y, self.cursor_x = clicked_y, clicked_x
-                        self.selection_start = (self.cursor_y, self.cursor_x)
-                        self.selection_end = self.selection_start
-                        return
-                    if bstate & curses.REPORT_MOUSE_POSITION and self.selection_start is not None:
-                        self.cursor_y, self.cursor_x = clicked_y, clicked_x
-                        self.selection_end = (self.cursor_y, self.cursor_x)
-                        return
-                    if bstate & curses.BUTTON1_RELEASED and self.selection_start is not None:
-                        self.cursor_y, self.cursor_x = clicked_y, clicked_x
-                        self.selection_end = (self.cursor_y, self.cursor_x)
-                        if self.selection_start == self.selection_end: self.clear_selection()
-                        return
-
-                # Handle clicks on the menu bar
-                if my == 0:
-                    self.menu_focus = True; self.message = "Menu Mode"
-                    action = self.menu.handle_mouse(mx, my)
-                    if action: self.handle_menu_action(action)
+            # Handle left-click actions in the content area
+            if my > 0 and my < height - 2:
+                line_num_width = 5 if self.show_line_numbers else 0
+                clicked_y = min(max(0, self.top_line + my - 1), self.buffer.line_count() - 1)
+                clicked_x = min(max(0, mx - line_num_width), self.buffer.line_length(clicked_y))
+
+                if bstate & curses.BUTTON1_CLICKED or bstate & curses.BUTTON1_PRESSED:
+                    self.clear_selection()
+                    self.cursor_y, self.cursor_x = clicked_y, clicked_x
+                    self.selection_start = (self.cursor_y, self.cursor_x)
+                    self.selection_end = self.selection_start
+                    return
+                if bstate & curses.REPORT_MOUSE_POSITION and self.selection_start is not None:
+                    self.cursor_y, self.cursor_x = clicked_y, clicked_x
+                    self.selection_end = (self.cursor_y, self.cursor_x)
+                    return
+                if bstate & curses.BUTTON1_RELEASED and self.selection_start is not None:
+                    self.cursor_y, self.cursor_x = clicked_y, clicked_x
+                    self.selection_end = (self.cursor_y, self.cursor_x)
+                    if self.selection_start == self.selection_end: self.clear_selection()
                     return
-                
-                # Handle scroll wheel
-                if bstate & curses.BUTTON4_PRESSED: self.scroll_up(); return
-                if bstate & curses.BUTTON5_PRESSED: self.scroll_down(); return
-            except curses.error: pass
-        
-        # --- Keyboard Input Logic ---
 
-        # Ctrl keys (for copy/paste/cut)
-        elif key == 26: self.undo()
-        elif key == 25: self.redo()
-        elif key == 3: self.copy_text()
-        elif key == 22: self.paste_text()
-        elif key == 24: self.cut_text()
+            # Handle clicks on the menu bar
+            if my == 0:
+                self.menu_focus = True; self.message = "Menu Mode"
+                action = self.menu.handle_mouse(mx, my)
+                if action: self.handle_menu_action(action)
+                return
+            
+            # Handle scroll wheel
+            if bstate & curses.BUTTON4_PRESSED: self.scroll_up(); return
+            if bstate & curses.BUTTON5_PRESSED: self.scroll_down(); return
+        except curses.error: pass
 
-        # Selection keys (Shift + Arrows)
-        elif key == curses.KEY_SLEFT: self._start_or_extend_selection(0, -1)
-        elif key == curses.KEY_SRIGHT: self._start_or_extend_selection(0, 1)
-        elif key == curses.KEY_SR: self._start_or_extend_selection(-1, 0)  # Shift+Up
-        elif key == curses.KEY_SF: self._start_or_extend_selection(1, 0)   # Shift+Down
+    def _move(self, dy, dx):
+        """Standard cursor movement, which clears the selection."""
+        self.clear_selection()
+        self.move_cursor(dy, dx)
 
-        # Standard cursor movement keys (these clear the selection)
-        elif key == curses.KEY_UP:
-            self.clear_selection()
-            self.move_cursor(-1, 0)
-        elif key == curses.KEY_DOWN:
-            self.clear_selection()
-            self.move_cursor(1, 0)
-        elif key == curses.KEY_LEFT:
-            self.clear_selection()
-            self.move_cursor(0, -1)
-        elif key == curses.KEY_RIGHT:
-            self.clear_selection()
-            self.move_cursor(0, 1)
-        elif key == curses.KEY_NPAGE:
-            self.clear_selection()
-            height, _ = self.stdscr.getmaxyx()
-            self.move_cursor(height - 3, 0)
-        elif key == curses.KEY_PPAGE:
-            self.clear_selection()
-            height, _ = self.stdscr.getmaxyx()
-            self.move_cursor(-(height - 3), 0)
-            
-        # Editing keys
-        elif key in [ord('\n'), ord('\r'), curses.KEY_ENTER, 459]:
-            self.insert_newline()
-        elif key in [curses.KEY_BACKSPACE, 127, 8]: 
-            self.backspace()
-        elif key == curses.KEY_DC: 
-            self.delete_forward()
-        elif key == ord('\t'):  # Tab key
-            self.insert_tab()
-            
-        # Function keys
-        elif key == curses.KEY_F1: 
-            self.open_file()
-        elif key == curses.KEY_F2: 
-            self.save_file()
-        elif key == curses.KEY_F3: 
-            self.new_file()
-        elif key == curses.KEY_F4: 
-            self.change_theme()
-        elif key == curses.KEY_F5:
-            self.show_line_numbers = not self.show_line_numbers
-            self.message = f"Line numbers turned {'on' if self.show_line_numbers else 'off'}."
-        
-        # Character input (also acts on selection)
-        elif 32 <= key <= 126:
-            self.insert_char(chr(key))
+    def _page(self, direction):
+        height, _ = self.stdscr.getmaxyx()
+        self._move(direction * (height - 3), 0)
 
     def clear_selection(self):
         """Clears any active text selection."""
@@ -1058,37 +3516,19 @@ class TextEditor:
         # Update the end of the selection to the new cursor position
         self.selection_end = (self.cursor_y, self.cursor_x)
 
-    def is_selected(self, y, x):
-        """Checks if a given coordinate (y, x) is within the current selection."""
-        if not self.selection_start or not self.selection_end:
-            return False
-
-        # Normalize coordinates so start is always before end
-        # This allows selecting text from bottom-to-top or right-to-left
-        start_pos = min(self.selection_start, self.selection_end)
-        end_pos = max(self.selection_start, self.selection_end)
-
-        # The character's position as a tuple
-        char_pos = (y, x)
-
-        # Check if the character's position is between the start and end of the selection
-        return start_pos <= char_pos < end_pos
+    def selection(self):
+        """Returns the current selection, rebuilt only when its endpoints change."""
+        # The endpoints are normalized, so selecting bottom-to-top or
+        # right-to-left gives the same ranges
+        endpoints = (self.selection_start, self.selection_end)
+        if endpoints != self._selection_endpoints:
+            self._selection_endpoints = endpoints
+            self._selection = Selection([endpoints] if None not in endpoints else ())
+        return self._selection
 
     def get_selected_text(self):
-        if not self.selection_start: return ""
-        start, end = min(self.selection_start, self.selection_end), max(self.selection_start, self.selection_end)
-        y1, x1 = start
-        y2, x2 = end
-        
-        if y1 == y2:
-            return self.content[y1][x1:x2]
-        else:
-            lines = []
-            lines.append(self.content[y1][x1:])
-            for i in range(y1 + 1, y2):
-                lines.append(self.content[i])
-            lines.append(self.content[y2][:x2])
-            return "\n".join(lines)
+        # Several ranges are copied one per line
+        return "\n".join(self.buffer.get_text(y1, x1, y2, x2) for (y1, x1), (y2, x2) in self.selection().ranges)
 
     def delete_selected_text(self, save_state=True):
         """Deletes the highlighted text and correctly repositions/scrolls the view."""
@@ -1098,33 +3538,21 @@ class TextEditor:
         if save_state:
             self._save_state()
 
-        start, end = min(self.selection_start, self.selection_end), max(self.selection_start, self.selection_end)
-        y1, x1 = start
-        y2, x2 = end
-        
+        ranges = self.selection().ranges
         # Bounds checking - ensure indices are valid
-        if y1 >= len(self.content) or y2 >= len(self.content):
+        if not ranges or ranges[-1][1][0] >= self.buffer.line_count():
             self.clear_selection()
-            self.message = "Invalid selection range"
+            if ranges:
+                self.message = "Invalid selection range"
             return
         
-        # Clamp x positions to line lengths
-        x1 = min(x1, len(self.content[y1]))
-        x2 = min(x2, len(self.content[y2]))
-        
-        if y1 == y2:
-            # Simple case: deletion is on a single line.
-            self.content[y1] = self.content[y1][:x1] + self.content[y1][x2:]
-        else:
-            # Multi-line case: Merge start of first line with end of last line.
-            self.content[y1] = self.content[y1][:x1] + self.content[y2][x2:]
-            
-            # Delete all the lines that were in between.
-            del self.content[y1 + 1 : y2 + 1]
-
-        # Ensure the document is never completely empty, which would cause a crash.
-        if not self.content:
-            self.content = ['']
+        # Delete from the last range back, so the earlier ranges do not move
+        for (y1, x1), (y2, x2) in reversed(ranges):
+            # Clamp x positions to line lengths
+            x1 = min(x1, self.buffer.line_length(y1))
+            x2 = min(x2, self.buffer.line_length(y2))
+            # A single buffer delete covers both the one-line and multi-line cases.
+            self.buffer.delete(y1, x1, y2, x2)
 
         # Correctly move the cursor to the start of the former selection
         self.cursor_y, self.cursor_x = y1, x1
@@ -1147,19 +3575,23 @@ class TextEditor:
         if self._check_read_only(): return
         if not self.selection_start:
             return
-        self._save_state()
         selected_text = self.get_selected_text()
         if selected_text:
             try:
                 pyperclip.copy(selected_text)
-                self.delete_selected_text()
+                with self.edit_transaction():
+                    self.delete_selected_text()
                 self.message = "Text cut to clipboard."
             except Exception as e:
                 self.message = f"Cut failed: {e}"
 
     def paste_text(self):
         if self._check_read_only(): return
-        self._save_state()
+        # Replacing the selection and inserting the paste undo together
+        with self.edit_transaction():
+            self._paste_clipboard()
+
+    def _paste_clipboard(self):
         if self.selection_start:
             self.delete_selected_text()
         
@@ -1173,34 +3605,9 @@ class TextEditor:
             if not lines_to_paste:
                 self.message = "No valid text to paste."
                 return
-                
-            current_line = self.content[self.cursor_y]
-            
-            # First line of paste is merged with current line
-            first_line_of_paste = lines_to_paste[0]
-            self.content[self.cursor_y] = current_line[:self.cursor_x] + first_line_of_paste
             
-            # If there are more lines, handle them
-            if len(lines_to_paste) > 1:
-                # The part of the original line after the cursor
-                end_of_current_line = current_line[self.cursor_x:]
-                
-                # The very last line of the paste
-                last_line_of_paste = lines_to_paste[-1]
-                
-                # Insert the middle lines
-                for i, line in enumerate(lines_to_paste[1:-1]):
-                    self.content.insert(self.cursor_y + 1 + i, line)
-                
-                # Insert the last line, appending the end of the original line
-                self.content.insert(self.cursor_y + len(lines_to_paste) - 1, last_line_of_paste + end_of_current_line)
-                
-                # Move cursor to the end of the paste
-                self.cursor_y += len(lines_to_paste) - 1
-                self.cursor_x = len(last_line_of_paste)
-            else:
-                # Only one line was pasted, move cursor to the end of it
-                self.cursor_x += len(first_line_of_paste)
+            # Insert the whole paste at once and move the cursor to its end
+            self.cursor_y, self.cursor_x = self.buffer.insert(self.cursor_y, self.cursor_x, "\n".join(lines_to_paste))
             
             self.message = "Pasted from clipboard."
             
@@ -1222,15 +3629,15 @@ class TextEditor:
             if self.cursor_y > max_visible_line:
                 self.cursor_y = max_visible_line
                 # Ensure cursor doesn't go past the end of content
-                self.cursor_y = min(self.cursor_y, len(self.content) - 1)
+                self.cursor_y = min(self.cursor_y, self.buffer.line_count() - 1)
                 # Ensure cursor x position is valid for the new line
-                self.cursor_x = min(self.cursor_x, len(self.content[self.cursor_y]))
+                self.cursor_x = min(self.cursor_x, self.buffer.line_length(self.cursor_y))
 
     def scroll_down(self, lines=3):
         """Scroll the view down by the specified number of lines"""
         height, _ = self.stdscr.getmaxyx()
         content_height = height - 4
-        max_top_line = max(0, len(self.content) - content_height)
+        max_top_line = max(0, self.buffer.line_count() - content_height)
         
         if self.top_line < max_top_line:
             self.top_line = min(max_top_line, self.top_line + lines)
@@ -1238,9 +3645,9 @@ class TextEditor:
             if self.cursor_y < self.top_line:
                 self.cursor_y = self.top_line
                 # Ensure cursor doesn't go past the end of content
-                self.cursor_y = min(self.cursor_y, len(self.content) - 1)
+                self.cursor_y = min(self.cursor_y, self.buffer.line_count() - 1)
                 # Ensure cursor x position is valid for the new line
-                self.cursor_x = min(self.cursor_x, len(self.content[self.cursor_y]))
+                self.cursor_x = min(self.cursor_x, self.buffer.line_length(self.cursor_y))
 
 
     def handle_menu_action(self, action):
@@ -1281,6 +3688,9 @@ class TextEditor:
                 self.message = f"Line numbers turned {'on' if self.show_line_numbers else 'off'}."
             elif item == "Change Theme":
                 self.change_theme()
+            elif item == "Detect Syntax":
+                self.update_lexer(redetect=True)
+                self.message = f"Syntax: {self.lexer.name}"
             # Close menu after menu operations
             self.menu.open = False
             self.menu_focus = False
@@ -1297,7 +3707,7 @@ class TextEditor:
     def move_cursor(self, dy, dx):
         """Moves the cursor and ensures it's visible."""
         # Calculate new y position
-        new_y = max(0, min(self.cursor_y + dy, len(self.content) - 1))
+        new_y = max(0, min(self.cursor_y + dy, self.buffer.line_count() - 1))
             
         # If moving to a different line, reset horizontal scroll
         if new_y != self.cursor_y and dy != 0:
@@ -1311,15 +3721,15 @@ class TextEditor:
         # Handle wrapping to previous line when moving left at start of line
         if new_x < 0 and self.cursor_y > 0:
             self.cursor_y -= 1
-            self.cursor_x = len(self.content[self.cursor_y])
+            self.cursor_x = self.buffer.line_length(self.cursor_y)
             self.left_col = 0  # Reset horizontal scroll
         # Handle wrapping to next line when moving right at end of line
-        elif new_x > len(self.content[self.cursor_y]) and self.cursor_y < len(self.content) - 1:
+        elif new_x > self.buffer.line_length(self.cursor_y) and self.cursor_y < self.buffer.line_count() - 1:
             self.cursor_y += 1
             self.cursor_x = 0
             self.left_col = 0  # Reset horizontal scroll
         else:
-            self.cursor_x = min(max(0, new_x), len(self.content[self.cursor_y]))
+            self.cursor_x = min(max(0, new_x), self.buffer.line_length(self.cursor_y))
         
         # Ensure the view scrolls if necessary
         self._ensure_cursor_visible()
@@ -1329,29 +3739,31 @@ class TextEditor:
         if self.read_only:
             self.message = "Read-Only Mode. Cannot modify file."
             return True
+        if not self.buffer.complete:
+            self.message = "File is still being indexed. Editing is disabled until it finishes."
+            return True
         return False
 
     def insert_char(self, char):
+        """Inserts typed text at the cursor; char may be a run of several characters."""
         if self._check_read_only(): return
-        self._save_state()
+        self._save_state(coalesce=True)
         if self.selection_start:
             self.delete_selected_text(save_state=False)  # Ensure no double-save state
-        line = self.content[self.cursor_y]
-        self.content[self.cursor_y] = line[:self.cursor_x] + char + line[self.cursor_x:]
-        self.cursor_x += 1
+        self.buffer.insert(self.cursor_y, self.cursor_x, char)
+        self.cursor_x += len(char)
         self._ensure_cursor_visible()
 
     def insert_tab(self):
         """Inserts a tab (as spaces) at the cursor position."""
         if self._check_read_only(): return
-        self._save_state()
+        self._save_state(coalesce=True)
         if self.selection_start:
             self.delete_selected_text(save_state=False)
         
         # Insert 4 spaces for a tab (you can change this number if you prefer)
         tab_spaces = "    "  # 4 spaces
-        line = self.content[self.cursor_y]
-        self.content[self.cursor_y] = line[:self.cursor_x] + tab_spaces + line[self.cursor_x:]
+        self.buffer.insert(self.cursor_y, self.cursor_x, tab_spaces)
         self.cursor_x += len(tab_spaces)
         self._ensure_cursor_visible()
       
@@ -1362,11 +3774,8 @@ class TextEditor:
         if self.selection_start:
             self.delete_selected_text()
 
-        line = self.content[self.cursor_y]
-        
-        # Split the line and insert the new part
-        self.content[self.cursor_y] = line[:self.cursor_x]
-        self.content.insert(self.cursor_y + 1, line[self.cursor_x:])
+        # Split the line by inserting a line break at the cursor
+        self.buffer.insert(self.cursor_y, self.cursor_x, "\n")
         
         # Move the cursor state
         self.cursor_y += 1
@@ -1383,12 +3792,11 @@ class TextEditor:
             self.delete_selected_text(save_state=False)
             return
         if self.cursor_x > 0:
-            line = self.content[self.cursor_y]
-            self.content[self.cursor_y] = line[:self.cursor_x - 1] + line[self.cursor_x:]
+            self.buffer.delete(self.cursor_y, self.cursor_x - 1, self.cursor_y, self.cursor_x)
             self.cursor_x -= 1
         elif self.cursor_y > 0:
-            prev_line_len = len(self.content[self.cursor_y - 1])
-            self.content[self.cursor_y - 1] += self.content.pop(self.cursor_y)
+            prev_line_len = self.buffer.line_length(self.cursor_y - 1)
+            self.buffer.delete(self.cursor_y - 1, prev_line_len, self.cursor_y, 0)
             self.cursor_y -= 1
             self.cursor_x = prev_line_len
             self.left_col = 0  # Reset horizontal scroll when joining lines
@@ -1401,11 +3809,11 @@ class TextEditor:
         if self.selection_start:
             self.delete_selected_text()
             return
-        line = self.content[self.cursor_y]
-        if self.cursor_x < len(line):
-            self.content[self.cursor_y] = line[:self.cursor_x] + line[self.cursor_x + 1:]
-        elif self.cursor_y < len(self.content) - 1:
-            self.content[self.cursor_y] += self.content.pop(self.cursor_y + 1)
+        line_len = self.buffer.line_length(self.cursor_y)
+        if self.cursor_x < line_len:
+            self.buffer.delete(self.cursor_y, self.cursor_x, self.cursor_y, self.cursor_x + 1)
+        elif self.cursor_y < self.buffer.line_count() - 1:
+            self.buffer.delete(self.cursor_y, line_len, self.cursor_y + 1, 0)
 
     def save_file(self, save_as=False):
         """Save the current file with improved error handling and validation."""
@@ -1438,23 +3846,33 @@ class TextEditor:
             return
         
         try:
-            valid_lines = [str(line) if line is not None else "" for line in self.content]
-            content_to_save = '\n'.join(valid_lines)
+            if self.buffer.lazy and (os.name == 'nt' or (
+                    save_in_place(filename_to_save) and os.path.samefile(filename_to_save, self.current_file))):
+                # Windows refuses to replace a mapped file, and a file that
+                # is overwritten in place cannot be read from at the same
+                # time, so the text is moved into memory and the map released
+                # first. Otherwise the map keeps the old file's data alive
+                # after it is replaced.
+                self._set_buffer(PieceTable(self.buffer.to_bytes(), self.buffer.encoding))
             
             directory = os.path.dirname(filename_to_save)
             if directory and not os.path.exists(directory):
                 os.makedirs(directory, exist_ok=True)
             
-            with open(filename_to_save, 'w', encoding='utf-8', newline='') as f:
-                f.write(content_to_save)
+            fingerprint = write_file_atomic(filename_to_save, self.buffer.iter_ranges(),
+                                            source_fd=self.buffer.source_fd)
             
             self.current_file = filename_to_save
             self.message = f"Saved to '{os.path.basename(self.current_file)}'"
             self.setup_colors()
+            self.update_lexer()  # Save As may have changed the file type
 
-            self.history = []
-            self.redo_stack = []
-            self._save_state() # Clear history on save
+            # Keep the history and store it next to the file for later sessions
+            log = self.journal.log
+            if PERSISTENT_UNDO:
+                if log is None or log.path != os.path.abspath(filename_to_save):
+                    self.journal.relocate(PersistentUndoLog(filename_to_save))
+                self.journal.save(fingerprint)
             
         except PermissionError:
             self.message = f"Permission denied: Cannot write to '{os.path.basename(filename_to_save)}'."
@@ -1492,6 +3910,7 @@ class TextEditor:
         finally:
             # Restore non-blocking input mode
             self.stdscr.nodelay(1)
+            self.damage.forget(self.stdscr.getmaxyx()[0] - 2)
         return response
 
     def open_file(self):
@@ -1506,7 +3925,8 @@ class TextEditor:
       
     def _load_file_content(self, filename):
         """
-        Loads file content by trying UTF-8 first, latin-1 fall back
+        Loads file content by trying UTF-8 first, latin-1 fall back.
+        The file is read once; only the decoding choice falls back.
         """
         # Validate the filename before trying to open it.
         if not (filename and os.path.exists(filename) and not os.path.isdir(filename)):
@@ -1519,42 +3939,91 @@ class TextEditor:
             return
 
         try:
-            # Try to open with UTF-8, the modern standard.
-            with open(filename, 'r', encoding='utf-8') as f:
-                content_lines = f.read().splitlines()
-            self.message = f"Opened {filename} (UTF-8)"
-
-        except UnicodeDecodeError:
-            # If UTF-8 fails, it's a legacy file. Fall back to 'latin-1'.
-            try:
-                with open(filename, 'r', encoding='latin-1') as f:
-                    content_lines = f.read().splitlines()
-                self.message = f"Opened {filename} (Decoded as Latin-1)"
-            except Exception as e:
-                # This would be a very unusual error, like a permission issue during the second read.
-                self.message = f"Error opening file on fallback: {e}"
-                return
+            with open(filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size >= LAZY_LOAD_THRESHOLD:
+                    # Huge file: map it and let the first screen show right away
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    # Kept open so saves can copy unchanged ranges from it
+                    source_fd = os.dup(f.fileno())
+                else:
+                    data = f.read()
         except Exception as e:
             # 4. Catch other file-related errors like permissions issues.
             self.message = f"Error opening file: {e}"
             return
-            
+
+        if isinstance(data, mmap.mmap):
+            self._set_buffer(PieceTable(data, indexed=False, source_fd=source_fd))
+            self.indexer = LineIndexer(data, filename, self.events.wakeup)
+            self.indexer.start()
+            self.message = f"Indexing {os.path.basename(filename)}..."
+            self._reset_for_loaded_file(filename)
+            return
+
+
+        try:
+            # Try UTF-8, the modern standard.
+            data.decode('utf-8')
+            encoding = 'utf-8'
+            self.message = f"Opened {filename} (UTF-8)"
+        except UnicodeDecodeError:
+            # If UTF-8 fails, it's a legacy file. Fall back to 'latin-1'.
+            encoding = 'latin-1'
+            self.message = f"Opened {filename} (Decoded as Latin-1)"
+
         # 5. If we successfully loaded the content, update the editor's state.
-        self.content = content_lines if content_lines else ['']
+        self._set_buffer(PieceTable(data, encoding))
+        self._reset_for_loaded_file(filename)
+        self._attach_undo_log(content_fingerprint(data))
+
+    def _reset_for_loaded_file(self, filename):
         self.current_file = filename
         self.read_only = False
         self.cursor_y, self.cursor_x, self.top_line = 0, 0, 0
         self.setup_colors() # Re-run syntax highlighting for the file type.
-        self.history = []; self.redo_stack = []; self._save_state()
+        self.update_lexer()
+        self.journal.clear()
+
+    def _attach_undo_log(self, fingerprint):
+        """Restores the undo history saved for this exact file content, if any."""
+        if not PERSISTENT_UNDO:
+            return
+        restored = self.journal.attach(PersistentUndoLog(self.current_file), fingerprint)
+        if restored:
+            self.message += f" - {restored} undo steps restored"
+
+    def _buffer_edited(self, kind, offset, data):
+        """Buffer listener: feeds every edit to the undo journal and the highlighter."""
+        self.journal.record(kind, offset, data)
+        newlines = data.count(b'\n')
+        y = self.buffer.line_of(offset)
+        if kind == 'i':
+            self.highlighter.invalidate(y, 0, newlines)
+        else:
+            self.highlighter.invalidate(y, newlines, 0)
+
+    def _set_buffer(self, buffer):
+        """Swaps in a new buffer, stopping any indexer and unmapping the old file."""
+        if self.indexer:
+            self.indexer.stop_event.set()
+            self.indexer = None
+        old_buffer, self.buffer = self.buffer, buffer
+        buffer.listener = self._buffer_edited
+        self.highlighter.close()
+        self.highlighter = SyntaxHighlighter(self.lexer, self.highlight_worker)
+        if old_buffer is not buffer:
+            old_buffer.listener = None
+            old_buffer.close()
 
     def new_file(self):
-        self.content = ['']
+        self._set_buffer(PieceTable())
         self.current_file = None
         self.read_only = False
         self.cursor_y, self.cursor_x, self.top_line = 0, 0, 0
         self.message = "New file created."
         self.setup_colors()
-        self.history = []; self.redo_stack = []; self._save_state()
+        self.update_lexer()
+        self.journal.clear()
 
     def change_theme(self):
         themes = sorted(list(get_all_styles()))
@@ -1608,7 +4077,7 @@ class TextEditor:
                 
                 # Get a single character
                 try:
-                    key = self.stdscr.getch()
+                    key = self.events.get_key()
                 except:
                     continue
 
@@ -1616,7 +4085,7 @@ class TextEditor:
                 if key == 27:
                     # Set a very brief non-blocking check
                     self.stdscr.nodelay(True)
-                    next_key = self.stdscr.getch()
+                    next_key = self.events.get_key()
                     self.stdscr.nodelay(False)
                     
                     if next_key == -1:
@@ -1624,7 +4093,7 @@ class TextEditor:
                         return None
                     else:
                         # It's part of an escape sequence, put it back and continue
-                        curses.ungetch(next_key)
+                        self.events.unget_keys([next_key])
                         continue
                 
                 # Handle enter key - confirm input
@@ -1674,6 +4143,53 @@ class TextEditor:
         finally:
             # Always restore the original state
             self.stdscr.nodelay(True)
+            self.damage.forget(height - 2)
+
+    # Commands that keys can be bound to, by the names the keymap uses
+    COMMANDS = {
+        "undo": undo,
+        "redo": redo,
+        "copy": copy_text,
+        "cut": cut_text,
+        "paste": paste_text,
+        "select_left": lambda self: self._start_or_extend_selection(0, -1),
+        "select_right": lambda self: self._start_or_extend_selection(0, 1),
+        "select_up": lambda self: self._start_or_extend_selection(-1, 0),
+        "select_down": lambda self: self._start_or_extend_selection(1, 0),
+        "left": lambda self: self._move(0, -1),
+        "right": lambda self: self._move(0, 1),
+        "up": lambda self: self._move(-1, 0),
+        "down": lambda self: self._move(1, 0),
+        "page_up": lambda self: self._page(-1),
+        "page_down": lambda self: self._page(1),
+        "newline": insert_newline,
+        "backspace": backspace,
+        "delete": delete_forward,
+        "tab": insert_tab,
+        "open": open_file,
+        "save": save_file,
+        "save_as": lambda self: self.save_file(save_as=True),
+        "new": new_file,
+        "theme": change_theme,
+        "line_numbers": toggle_line_numbers,
+        "toggle_menu": toggle_menu_focus,
+        "escape": _escape,
+        "mouse": _editor_mouse,
+        "menu_mouse": _menu_mouse,
+        "menu_select": lambda self: self._menu_action(self.menu.select()),
+        "menu_left": lambda self: self.menu.move(-1),
+        "menu_right": lambda self: self.menu.move(1),
+        "menu_up": lambda self: self.menu.move_submenu(-1),
+        "menu_down": lambda self: self.menu.move_submenu(1),
+        "browser_mouse": _browser_mouse,
+        "browser_up": lambda self: self.file_browser.move(-1),
+        "browser_down": lambda self: self.file_browser.move(1),
+        "browser_parent": lambda self: self.file_browser.parent(),
+        "browser_open": lambda self: self._browser_result(self.file_browser.select()),
+        "browser_cancel": lambda self: self._browser_result("CANCEL"),
+        "context_mouse": _context_menu_mouse,
+        "context_close": _close_context_menu,
+    }
 
 def main(stdscr):
     try:
@@ -0,0 +1,76 @@
+# Tests for the incremental syntax highlighter.
+# Run from the repository root with: python -m pytest tests
+
+import os
+import sys
+
+from pygments.lexers import get_lexer_by_name
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import te
+
+
+def _highlighted(buffer, highlighter):
+    highlighter.update(buffer, 0, buffer.line_count() - 1)
+    return [highlighter.line_runs(buffer, y) for y in range(buffer.line_count())]
+
+
+def test_closing_a_comment_relexes_the_lines_above():
+    lexer = get_lexer_by_name("javascript")
+    buffer = te.PieceTable(b"/* start\ntext\n")
+    highlighter = te.SyntaxHighlighter(lexer)
+    _highlighted(buffer, highlighter)
+
+    buffer.insert(1, 4, " end */")
+    highlighter.invalidate(1, 0, 0)
+
+    runs = _highlighted(buffer, highlighter)
+    assert runs == _highlighted(buffer, te.SyntaxHighlighter(lexer))
+    assert runs[0] == [(te.Token.Comment.Multiline, "/* start")]
+    assert runs[1] == [(te.Token.Comment.Multiline, "text end */")]
+
+
+def test_editing_the_end_of_a_multiline_token_relexes_from_its_start():
+    lexer = get_lexer_by_name("html")
+    buffer = te.PieceTable(b"<html>\n<script>\nvar a = 1;\n</script>\n</html>\n")
+    highlighter = te.SyntaxHighlighter(lexer)
+    _highlighted(buffer, highlighter)
+
+    # "</cript>" no longer ends the script, so the lookahead that made
+    # lines 1-2 a single match fails
+    buffer.delete(3, 2, 3, 3)
+    highlighter.invalidate(3, 0, 0)
+
+    runs = _highlighted(buffer, highlighter)
+    assert runs == _highlighted(buffer, te.SyntaxHighlighter(lexer))
+    assert runs[3] == [(te.Token.Punctuation, "<"), (te.Token.Punctuation, "/"),
+                       (te.Token.Name.Tag, "cript"), (te.Token.Punctuation, ">")]
+
+
+def test_closing_a_docstring_relexes_the_line_that_opened_it():
+    lexer = get_lexer_by_name("python")
+    buffer = te.PieceTable(b'def f():\n    """doc\n    more""\n')
+    highlighter = te.SyntaxHighlighter(lexer)
+    _highlighted(buffer, highlighter)
+
+    buffer.insert(2, 10, '"')
+    highlighter.invalidate(2, 0, 0)
+
+    runs = _highlighted(buffer, highlighter)
+    assert runs == _highlighted(buffer, te.SyntaxHighlighter(lexer))
+    assert runs[1][-1] == (te.Token.String.Doc, '"""doc')
+    assert runs[2] == [(te.Token.String.Doc, '    more"""')]
+
+
+def test_start_of_text_rules_only_match_on_the_first_line():
+    lexer = get_lexer_by_name("python")
+    buffer = te.PieceTable(b"a = 1\nb = 2\nc = 3\n\nd = 4\n")
+    highlighter = te.SyntaxHighlighter(lexer)
+    _highlighted(buffer, highlighter)
+
+    buffer.insert(3, 0, "#!*")
+    highlighter.invalidate(3, 0, 0)
+
+    runs = _highlighted(buffer, highlighter)
+    assert runs == _highlighted(buffer, te.SyntaxHighlighter(lexer))
+    assert runs[3] == [(te.Token.Comment.Single, "#!*")]